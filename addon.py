@@ -3,530 +3,683 @@ Basic skeleton of a mitmproxy addon.
 
 Run as follows: mitmproxy -s addon.py
 """
+import os
+import sys
 import logging
 import json
+import re
 import time
-import random
+import asyncio
+import importlib.util
+import threading
+import concurrent.futures
 
-from mitmproxy import http
+from mitmproxy import ctx, http
 from datetime import datetime
+from urllib.parse import unquote
+
+from archive import write_archive
+from backends import BACKENDS, passthrough
+from baseline import Baseline
+from changeset import ChangesetLog, compact_log, compacted, make_asset
+from events import LEVELS, EventLog
+from metrics import Metrics
+from profiling import MODES, Profiler
+from replay import CREDENTIAL_HOSTS, ReplayCache, fake_token, request_key
+from store import Record, ResourceStore
+
+# seconds between checks of how late the event loop runs, for the metrics
+LAG_INTERVAL = 0.1
+
+# where the backend modules are, next to the addon
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class Session:
+  """
+  Everything captured for one terraform run.
+
+  A cold mitmdump only ever has the default session.  With the sessions
+  option a warm proxy keeps one per proxy-auth user (or per listen port)
+  so back-to-back runs don't see each other's resources.
+  """
+  def __init__(self, name: str) -> None:
+    self.name = name
+    # held while a flow changes the stores below or serializes one of their records, never while it
+    # decodes a body or builds a resource, so the flows of one session only wait on each other for that
+    self.lock = threading.RLock()
+    # captured assets, and the compute/run operations terraform polls
+    self.resources = ResourceStore()
+    self.operations = ResourceStore()
+    # set when captured assets are streamed to an append-only log
+    self.changeset_log = None
+    # existing assets to diff captured resources against, the addon's baseline option
+    self.baseline = None
+
+  def capture(self, asset_type: str, key: str, resource: dict) -> Record:
+    # store a captured resource, and stream it out if a changeset log is open
+    changeset_log = self.changeset_log
+    asset = None
+    if changeset_log is not None:
+      asset = make_asset(asset_type, key, resource, self.baseline, ctx.options.baseline_noops == "keep")
+    with self.lock:
+      record = self.resources.put(asset_type, key, resource)
+      if asset is not None:
+        changeset_log.append(asset_type +":"+ key, asset)
+    return record
+
+  def assets(self):
+    # every captured resource as an asset, one at a time
+    for record in self.resources:
+        asset = make_asset(record.asset_type, record.key, record.data, self.baseline, ctx.options.baseline_noops == "keep")
+        if asset["action"] == "NOOP" and ctx.options.baseline_noops == "omit":
+          continue
+        yield asset
+
+  def changeset(self) -> dict:
+    # Collect all resources to assets list
+    return {
+      "type": "changeset",
+      "date": datetime.now().isoformat(),
+      "assets": list(self.assets())
+    }
+
+  def spill_to(self, directory: str, max_mb: int) -> None:
+    # bound the memory of the captured resources, operations are few and polled so they stay in memory
+    self.resources.spill_to(directory, max_mb * 2 ** 20)
 
-resources = {}
-project_iam_policies = {}
-compute_operations = {}
-run_operations = {}
+  def close(self) -> None:
+    self.resources.close()
 
 class TerraFaker:
   def __init__(self) -> None:
     self.num_count = 0
-
-  def request(self, flow: http.HTTPFlow) -> None:
+    self.default_session = Session("default")
+    self.sessions = {}
+    self.events = EventLog()
+    self.metrics = Metrics(self.resource_counts)
+    self.profiler = Profiler()
+    self.replay = None
+    self.baseline = None
+    # worker threads for faker flows, None handles them on the event loop
+    self.pool = None
+    self.sessions_lock = threading.Lock()
+    # set once the proxy is listening, for callers embedding mitmproxy
+    self.ready = threading.Event()
+    self.lag_watch = None
+
+  def load(self, loader) -> None:
+    loader.add_option(
+      name="changeset_log",
+      typespec=str,
+      default="",
+      help="Stream captured assets to this NDJSON file and compact it into changeset.json on shutdown",
+    )
+    loader.add_option(
+      name="changeset_file",
+      typespec=str,
+      default="changeset.json",
+      help="Where done() writes the default session's changeset, empty to not write one",
+    )
+    loader.add_option(
+      name="changeset_format",
+      typespec=str,
+      default="json",
+      choices=["json", "archive"],
+      help="Write the changeset as one json document, or as a compressed archive with an index (see archive.py)",
+    )
+    loader.add_option(
+      name="baseline",
+      typespec=str,
+      default="",
+      help="Asset export or baseline index (see baseline.py) to mark captured assets CREATE, UPDATE or NOOP against",
+    )
+    loader.add_option(
+      name="baseline_noops",
+      typespec=str,
+      default="omit",
+      choices=["omit", "collapse", "keep"],
+      help="Leave unchanged assets out of the changeset, send them without data, or send them in full",
+    )
+    loader.add_option(
+      name="event_log",
+      typespec=str,
+      default="",
+      help="Write the addon's structured events to this NDJSON file",
+    )
+    loader.add_option(
+      name="event_level",
+      typespec=str,
+      default="info",
+      choices=list(LEVELS),
+      help="Lowest level of event that is recorded",
+    )
+    loader.add_option(
+      name="event_body_sample",
+      typespec=int,
+      default=0,
+      help="At debug level, attach the request body to one in this many flow events (0 for none)",
+    )
+    loader.add_option(
+      name="event_dump",
+      typespec=str,
+      default="psychiac-events-dump.ndjson",
+      help="Where the recent events are dumped when a handler fails",
+    )
+    loader.add_option(
+      name="replay",
+      typespec=str,
+      default="",
+      help="Record upstream responses for calls the fakers pass through in this sqlite file and replay them",
+    )
+    loader.add_option(
+      name="replay_mode",
+      typespec=str,
+      default="record",
+      choices=["record", "offline", "refresh"],
+      help="record: replay hits and record misses, offline: replay hits and fail misses, refresh: always go upstream and re-record",
+    )
+    loader.add_option(
+      name="replay_ttl",
+      typespec=int,
+      default=86400,
+      help="Seconds a recorded response is replayed for, 0 for forever",
+    )
+    loader.add_option(
+      name="spill_dir",
+      typespec=str,
+      default="",
+      help="Keep captured resources over spill_mb on disk in this directory instead of in memory",
+    )
+    loader.add_option(
+      name="spill_mb",
+      typespec=int,
+      default=512,
+      help="Serialized size of the captured resources each session keeps in memory when spill_dir is set",
+    )
+    loader.add_option(
+      name="workers",
+      typespec=int,
+      default=0,
+      help="Handle terraform and control flows on this many worker threads, so the proxy event loop never waits on "
+           "a session or the disk, 0 handles them inline",
+    )
+    loader.add_option(
+      name="metrics_port",
+      typespec=int,
+      default=0,
+      help="Serve per-route metrics in the Prometheus text format on this local port, 0 for off",
+    )
+    loader.add_option(
+      name="metrics_file",
+      typespec=str,
+      default="metrics.json",
+      help="Write a summary of the per-route metrics here at shutdown, next to changeset_file and only with one, empty for none",
+    )
+    profile = os.environ.get("PSYCHIAC_PROFILE", "off")
+    loader.add_option(
+      name="profile",
+      typespec=str,
+      default=profile if profile in MODES else "off",
+      choices=MODES,
+      help="Profile flow handling and the changeset write per route, defaults to $PSYCHIAC_PROFILE",
+    )
+    loader.add_option(
+      name="profile_dir",
+      typespec=str,
+      default="profile",
+      help="Write the profile here as <route>.pstats, and profile.folded for flamegraphs when sampling",
+    )
+    loader.add_option(
+      name="profile_interval",
+      typespec=int,
+      default=1000,
+      help="Microseconds between stack samples in the sampling profile mode",
+    )
+    loader.add_option(
+      name="sessions",
+      typespec=bool,
+      default=False,
+      help="Keep a separate capture per proxy-auth user or listen port, managed through http://"+ CONTROL_HOST,
+    )
+
+  def configure(self, updated) -> None:
+    if "baseline" in updated:
+      if self.baseline is not None:
+        self.baseline.close()
+        self.baseline = None
+      if ctx.options.baseline:
+        logging.info("Loading baseline: "+ ctx.options.baseline)
+        self.baseline = Baseline(ctx.options.baseline)
+      with self.sessions_lock:
+        sessions = [self.default_session] + list(self.sessions.values())
+      for session in sessions:
+        session.baseline = self.baseline
+
+    if updated & {"event_log", "event_level", "event_body_sample"}:
+      self.events.close()
+      self.events = EventLog(ctx.options.event_log, ctx.options.event_level,
+                             body_sample=ctx.options.event_body_sample)
+
+    if updated & {"replay", "replay_ttl"}:
+      if self.replay is not None:
+        self.replay.close()
+        self.replay = None
+      if ctx.options.replay:
+        self.replay = ReplayCache(ctx.options.replay, ctx.options.replay_ttl)
+
+    if "workers" in updated:
+      if self.pool is not None:
+        self.pool.shutdown()
+        self.pool = None
+      if ctx.options.workers > 0:
+        self.pool = concurrent.futures.ThreadPoolExecutor(ctx.options.workers, thread_name_prefix="psychiac-worker")
+
+    if "metrics_port" in updated:
+      self.metrics.stop()
+      if ctx.options.metrics_port:
+        self.metrics.serve(ctx.options.metrics_port)
+
+    if updated & {"profile", "profile_interval"}:
+      # switching modes on a running proxy writes out what was profiled so far
+      self.write_profile()
+      self.profiler = Profiler(ctx.options.profile, ctx.options.profile_interval)
+
+    if updated & {"spill_dir", "spill_mb"}:
+      with self.sessions_lock:
+        sessions = [self.default_session] + list(self.sessions.values())
+      for session in sessions:
+        with session.lock:
+          session.spill_to(ctx.options.spill_dir, ctx.options.spill_mb)
+
+    if "changeset_log" in updated:
+      session = self.default_session
+      if session.changeset_log is not None:
+        session.changeset_log.close()
+        session.changeset_log = None
+      if ctx.options.changeset_log:
+        session.changeset_log = ChangesetLog(ctx.options.changeset_log)
+
+  def running(self) -> None:
+    self.lag_watch = asyncio.get_running_loop().create_task(self.watch_loop())
+    self.ready.set()
+
+  async def watch_loop(self) -> None:
+    # a loop busy with flows runs this timer late, which is the queueing every flow sees
+    while True:
+      start = time.perf_counter()
+      await asyncio.sleep(LAG_INTERVAL)
+      self.metrics.loop_lag(max(time.perf_counter() - start - LAG_INTERVAL, 0.0))
+
+  def session_for(self, flow: http.HTTPFlow) -> Session:
+    if not ctx.options.sessions:
+      return self.default_session
+
+    # proxyauth puts the (user, password) of the run in the flow metadata
+    auth = flow.metadata.get("proxyauth")
+    name = auth[0] if auth else str(flow.client_conn.sockname[1])
+    with self.sessions_lock:
+      session = self.sessions.get(name)
+      if session is None:
+        logging.info("Opening session: "+ name)
+        session = self.sessions[name] = self.new_session(name)
+    return session
+
+  def resource_counts(self) -> dict:
+    # captured resources by asset type over every session, for the metrics
+    with self.sessions_lock:
+      sessions = [self.default_session] + list(self.sessions.values())
+    counts = {}
+    for session in sessions:
+      for asset_type, records in list(session.resources.by_type.items()):
+        counts[asset_type] = counts.get(asset_type, 0) + len(records)
+    return counts
+
+  def new_session(self, name: str) -> Session:
+    session = Session(name)
+    session.baseline = self.baseline
+    if ctx.options.spill_dir:
+      session.spill_to(ctx.options.spill_dir, ctx.options.spill_mb)
+    return session
+
+  async def request(self, flow: http.HTTPFlow) -> None:
+    # with workers, terraform and control flows are handled off the event loop, which keeps accepting and
+    # proxying meanwhile and never waits on a session, the replay cache or the disk.  The rest only need a glance.
+    fr = flow.request
+    if self.pool is None or fr.host != CONTROL_HOST and "erraform" not in fr.headers.get("user-agent", ""):
+      self.profiler.run(None, self.handle, flow)
+    else:
+      self.metrics.queue(1)
+      try:
+        await asyncio.get_running_loop().run_in_executor(self.pool, self.profiler.run, None, self.handle, flow)
+      finally:
+        self.metrics.queue(-1)
+
+  def handle(self, flow: http.HTTPFlow) -> str:
+    # fake, replay or pass on a flow, returns the route it took
     fr = flow.request
     frh = flow.request.headers
-    if 'user-agent' in frh and 'erraform' in frh['user-agent']:
-      if "googleapis.com" in fr.host:
-        resp = GoogleFaker().parse_terraform_google(flow)
-        if resp:
-         self.respond_to_terraform(flow, resp)
+    if fr.host == CONTROL_HOST:
+      handler, params, route = control.match(fr.host, fr.method, fr.path)
+      resp = handler(self, params) if handler else None
+      if resp is None:
+        flow.response = http.Response.make(404, b"", {"Content-Type": "application/json"})
       else:
+        self.respond_to_terraform(flow, resp)
+      return
+
+    if 'user-agent' in frh and 'erraform' in frh['user-agent']:
+      start = time.perf_counter()
+      handler, params, route = router.match(fr.host, fr.method, fr.path)
+      if handler is None:
         logging.info("Skipping processing for: "+ fr.url)
+        action = self.replay_upstream(flow) or "skipped"
+        latency = time.perf_counter() - start
+        self.observe(flow, fr.host, "unmatched" if action == "skipped" else action, latency)
+        self.events.emit(logging.INFO, "flow", fr.host, fr.path, action, latency)
+        return fr.host
+
+      session = flow.metadata["psychiac.session"] = self.session_for(flow)
+      key = params.get("name") or params.get("project", "")
+      try:
+        # handlers lock the session only to change it.  Terraform only polls an operation
+        # after the call that started it was answered, so operations stay in order.
+        resp = handler(flow, params)
+        if isinstance(resp, Record):
+          # serialize while no other flow can change the record
+          with session.lock:
+            key = resp.key
+            resp = resp.payload()
+      except Exception:
+        self.observe(flow, route, "error", time.perf_counter() - start)
+        body = fr.content if self.events.wants_body() else None
+        self.events.emit(logging.ERROR, "flow", route, key, "error", time.perf_counter() - start, body)
+        self.events.dump(ctx.options.event_dump)
+        raise
+
+      if resp is None:
+        action = self.replay_upstream(flow) or "passthrough"
+      else:
+        self.respond_to_terraform(flow, resp)
+        action = "faked"
+
+      latency = time.perf_counter() - start
+      # a faked GET of an operation is terraform polling it
+      poll = key if action == "faked" and fr.method == "GET" and "/operations/" in route else None
+      self.observe(flow, route, action, latency, poll)
+      if self.events.enabled(logging.INFO):
+        body = fr.content if self.events.wants_body() else None
+        self.events.emit(logging.INFO, "flow", route, key, action, latency, body)
+      return route
+
+  def observe(self, flow: http.HTTPFlow, route: str, outcome: str, latency: float, poll: str = None) -> None:
+    if flow.response is None:
+      # going upstream, its response bytes are counted when it answers
+      flow.metadata["psychiac.route"] = route
+      bytes_out = 0
+    else:
+      bytes_out = len(flow.response.raw_content or b"")
+    self.metrics.observe(route, outcome, latency, len(flow.request.raw_content or b""), bytes_out, poll)
+
 
+  def replay_upstream(self, flow: http.HTTPFlow) -> str:
+    # answer a flow that would go to the real API from the replay cache, returns what was done
+    if self.replay is None:
+      return None
+
+    fr = flow.request
+    mode = ctx.options.replay_mode
+    if fr.host in CREDENTIAL_HOSTS:
+      # tokens are never recorded, offline nothing goes upstream to use a real one anyway
+      if mode != "offline":
+        return None
+      self.respond_to_terraform(flow, fake_token(fr.host))
+      return "replayed"
+
+    key = request_key(fr.method, fr.url, fr.content or b"")
+    hit = None
+    if mode in ("offline", "record"):
+      hit = self.replay.lookup(key)
+
+    if hit is not None:
+      status, headers, content = hit
+      flow.response = http.Response.make(status, b"", {})
+      flow.response.headers = http.Headers([(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers])
+      flow.response.headers["content-length"] = str(len(content))
+      flow.response.raw_content = content
+      return "replayed"
+
+    if mode == "offline":
+      logging.warning("No recorded response in offline mode for: "+ fr.method +" "+ fr.url)
+      error = {"error": {"code": 502, "status": "UNAVAILABLE",
+                         "message": "psychiac: no recorded response for "+ fr.method +" "+ fr.url}}
+      flow.response = http.Response.make(502, json.dumps(error).encode("utf-8"), {"Content-Type": "application/json"})
+      return "replay-miss"
+
+    flow.metadata["psychiac.replay"] = key
+    return None
+
+  async def response(self, flow: http.HTTPFlow) -> None:
+    if "psychiac.route" in flow.metadata:
+      self.metrics.upstream(flow.metadata["psychiac.route"], len(flow.response.raw_content or b""),
+                            flow.response.status_code)
+    if "psychiac.replay" not in flow.metadata or self.replay is None:
+      return
+    if self.pool is None:
+      self.record_upstream(flow)
+    else:
+      await asyncio.get_running_loop().run_in_executor(self.pool, self.record_upstream, flow)
 
-  def respond_to_terraform(self, flow: http.HTTPFlow, body: dict) -> None:
-      payload_bytes = json.dumps(body).encode('utf-8')
+  def record_upstream(self, flow: http.HTTPFlow) -> None:
+    # record what the real API answered for a flow that missed the replay cache
+    key = flow.metadata["psychiac.replay"]
+    fr = flow.request
+    status = flow.response.status_code
+    if status >= 500 or status == 429:
+      return
+    headers = [(k, v) for k, v in flow.response.headers.items(multi=True)]
+    self.replay.record(key, fr.method, fr.url, status, headers, flow.response.raw_content or b"")
+
+  def respond_to_terraform(self, flow: http.HTTPFlow, body) -> None:
+      # stored records answer with their cached serialization
+      if isinstance(body, bytes):
+        payload_bytes = body
+      else:
+        payload_bytes = json.dumps(body).encode('utf-8')
       flow.response = http.Response.make(
         200,
         payload_bytes,
         {"Content-Type": "application/json"},
       )
-      logging.info(flow.response.content)
-      logging.info("")
 
   # Called when the addon shuts down
   def done(self):
-    # Collect all resources to assets list
-    assets = []
-    for k, v in resources.items():
-        asset = {}
-        asset["name"] = v.get("name")
-        asset["type"] = k.split(":")[0]
-        asset["action"] = "UPSERT"
-        asset["update_time"] = datetime.now().isoformat()
-        asset["data"] = v
-        assets.append(asset)
-    
-    # Write out json assets created to a file
-    logging.info("writing assets to file...")
-    print(json.dumps(assets, indent=2))
-    with open('changeset.json', 'w') as outfile:
-      changeset_data = {
-        "type": "changeset",
-        "date": datetime.now().isoformat(),
-        "assets": assets
-      }
-      json.dump(changeset_data, outfile)
-
+    if self.lag_watch is not None:
+      self.lag_watch.cancel()
+      self.lag_watch = None
+    if self.pool is not None:
+      self.pool.shutdown()
+      self.pool = None
+    start = time.perf_counter()
+    action = self.profiler.run("done", self.write_changeset)
+    self.events.emit(logging.INFO, "done", "", ctx.options.changeset_file, action, time.perf_counter() - start)
+    self.events.close()
+    self.metrics.stop()
+    if ctx.options.metrics_file and ctx.options.changeset_file:
+      # relative to the changeset, so each run's summary lands next to its changeset.json.  Proxies that
+      # don't write one (sessions, embedded) have nowhere of their own to put it, their callers read /summary
+      self.metrics.write(os.path.join(os.path.dirname(ctx.options.changeset_file), ctx.options.metrics_file))
+    for session in [self.default_session] + list(self.sessions.values()):
+      session.close()
+    self.write_profile()
     logging.info("Done")
 
-class GoogleFaker:
-  def __init__(self) -> None:
-    self.num_count = 0
-
-  def parse_terraform_google(self, flow: http.HTTPFlow) -> str:
-    fr = flow.request
-    if not self.is_supported_service(fr.host):
-      return None
-
-    if fr.host == "iam.googleapis.com":
-      return GoogleIamFaker().parse(flow)
-    
-    if fr.host == "cloudresourcemanager.googleapis.com":
-      return GoogleCrmFaker().parse(flow)
-
-    if fr.host == "compute.googleapis.com":
-      return GoogleComputeFaker().parse(flow)
-
-    if fr.host == "run.googleapis.com":
-      return GoogleRunFaker().parse(flow)
-
-
-  def is_supported_service(self, host: str) -> bool:
-    supported_services = ['iam', 'compute', 'cloudresourcemanager', 'run', 'runadmin']
-    # Parse host into subdomain and domain
-    subdomain = host.split(".")[0]
-    if subdomain in supported_services:
-      return True
-
-    return False
-
-
-class GoogleRunFaker:
-  def __init__(self) -> None:
-    self.num_count = 0
-
-  def parse(self, flow: http.HTTPFlow) -> dict:
-    fr = flow.request
-    pcs = flow.request.path_components
-
-    if fr.method == "PATCH" and pcs[0] == "v2":
-      # parse and store the cloudrun , return the operation id
-      run_operation_id = self.parse_patch_run(flow)
-
-      # return the create instance operation
-      return self.get_run_operation(run_operation_id)
-    elif fr.method == "GET" and pcs[0] == "v2" and pcs[6] == "operations":
-      run_operation_id = self.parse_run_operation_for_id(flow)
-      return self.get_run_operation(run_operation_id)
-    return None
-
-  def parse_patch_run(self, flow: http.HTTPFlow) -> str:
-    fr = flow.request
-    pcs = flow.request.path_components
-    api_version = pcs[0]
-    project_id = pcs[2]
-    location = pcs[4]
-    svc_name = pcs[6]
-    # parse the run instance body from the request
-    location_url = "https://run.googleapis.com/"+ api_version +"/projects/"+ project_id +"/locations/"+ location
-    run_url = location_url +"/services/"+ svc_name
-
-    run_detail = fr.json()
-    run_detail["name"] = run_url
-
-    # Store the cloudrun service as a resource
-    resources["gcp_run_service:"+ run_url] = run_detail
-
-    # parse the project-id and zone from the path componet
-    operation_id = random.randint(1000000000000000000, 9999999999999999999)
-    operation_name = "operation-run-patch-"+ project_id +"-"+ location +"-"+ svc_name
-
-    # Create a new run operation
-    operation = {
-      "name": f"projects/ln-prod-web/locations/us-central1/operations/{operation_id}"
-    }
-
-    logging.info("Storing operation in PENDING: "+ operation_name)
-    run_operations[operation_name] = operation
-
-    # return the operation id
-    return operation_name
-
-  def get_run_operation(self, operation_id: str) -> dict:
-    # return the operation by operation_id, advancing the state of the operation each time
-    logging.info("Getting a Cloud Run Operation: "+ operation_id)
-    operation = run_operations.get(operation_id)
-
-    # if pending, change to done
-    if operation.get("done") is None:
-      logging.info("Setting operation to DONE: "+ operation_id)
-      operation["done"] = True
-
-    return operation
-
-  def parse_run_operation_for_id(self, flow: http.HTTPFlow) -> str:
-    fr = flow.request
-    pcs = flow.request.path_components
-   
-    project_id = pcs[3]
-    location = pcs[5] 
-    svc = fr.json().get('name') or "no-svc-name"
-    operation_name = "operation-run-patch-"+ project_id +"-"+ location +"-"+ svc_name
-      
-    return operation_name
-
-
-class GoogleCrmFaker:
-  def __init__(self) -> None:
-    self.num_count = 0
-
-  def parse(self, flow: http.HTTPFlow) -> dict:
-    fr = flow.request
-    pcs = flow.request.path_components
-
-
-    # Get the IAM policy for a project
-    if fr.method == "POST" and pcs[0] == "v1" and pcs[1] == "projects" and ":getIamPolicy" in pcs[2]:
-      # parse the project-id from the path componet
-      project_id = pcs[2].split(":")[0]
-      # if we've already created an IAM policy for this project, return it
-      if project_id in project_iam_policies:
-        logging.info("Fetching IAM policy for project: "+ project_id)
-        return project_iam_policies[project_id]
-      # else allow the request to go through
-      else:
-        logging.info("Storing IAM policy for project: "+ project_id)
-        return None
-    elif fr.method == "POST" and pcs[0] == "v1" and pcs[1] == "projects" and ":setIamPolicy" in pcs[2]:
-      # parse the project-id from the path componet
-      project_id = pcs[2].split(":")[0]
-      # parse the iam policy from the request body
-      policy = fr.json()
-      policy['version'] = 1
-      policy['etag'] = "BwYR2wZdArY="
-      project_iam_policies[project_id] = policy.get('policy')
-
-      resources["gcp_cloudresourcemanager_iam_policy:"+ project_id] = policy.get('policy')
-      resources["gcp_cloudresourcemanager_iam_policy:"+ project_id]["name"] = "projects/"+ project_id
-      # if we've already created an IAM policy for this project, return it
-      if project_id in project_iam_policies:
-        logging.info("Returning IAM policy for project: "+ project_id)
-        return project_iam_policies[project_id]
-      # else return an error
-      else:
-        return {}
+  def write_profile(self) -> None:
+    if self.profiler.enabled():
+      logging.info("Writing "+ self.profiler.mode +" profile to: "+ ctx.options.profile_dir)
+      self.profiler.write(ctx.options.profile_dir)
+
+  def write_changeset(self) -> str:
+    session = self.default_session
+    changeset_file = ctx.options.changeset_file
+    # Assets were already streamed out during the run, only compact the log
+    if session.changeset_log is not None:
+      session.changeset_log.close()
+      if changeset_file:
+        logging.info("compacting changeset log...")
+        omit_noops = ctx.options.baseline_noops == "omit"
+        if ctx.options.changeset_format == "archive":
+          write_archive(compacted(session.changeset_log.path, omit_noops), changeset_file)
+        else:
+          compact_log(session.changeset_log.path, changeset_file, omit_noops=omit_noops)
+        return "compacted"
+      return "skipped"
+
+    if not changeset_file:
+      return "skipped"
+
+    # Write out json assets created to a file, one at a time as spilled resources are read back
+    logging.info("writing assets to file...")
+    if ctx.options.changeset_format == "archive":
+      write_archive(session.assets(), changeset_file)
     else:
-      return {}
-
-class GoogleIamFaker:
-
-  def __init__(self) -> None:
-    self.num_count = 0
-
-  def parse(self, flow: http.HTTPFlow) -> dict:
-    fr = flow.request
+      with open(changeset_file, 'w') as outfile:
+        outfile.write('{"type": "changeset", "date": '+ json.dumps(datetime.now().isoformat()) +', "assets": [')
+        for i, asset in enumerate(session.assets()):
+          if i:
+            outfile.write(", ")
+          json.dump(asset, outfile)
+        outfile.write("]}")
+    return "written"
+
+  # Control API for warm proxies, reached through the proxy at http://psychiac.control
+  def list_sessions(self, params: dict) -> dict:
+    with self.sessions_lock:
+      return {name: len(session.resources) for name, session in self.sessions.items()}
+
+  def open_session(self, params: dict) -> dict:
+    # (re)open a session with nothing captured yet
+    name = params["session"]
+    logging.info("Opening session: "+ name)
+    session = self.new_session(name)
+    with self.sessions_lock:
+      old = self.sessions.get(name)
+      self.sessions[name] = session
+    if old is not None:
+      old.close()
+    return {"session": name}
+
+  def get_session_changeset(self, params: dict) -> dict:
+    with self.sessions_lock:
+      session = self.sessions.get(params["session"])
+    if session is None:
+      return None
+    with session.lock:
+      return session.changeset()
 
-    pcs = flow.request.path_components
-    # Create a GCP Service Account
-    if fr.method == "POST" and pcs[0] == "v1" and pcs[1] == "projects" and pcs[3] == "serviceAccounts":
-      resource = self.parse_post_service_account(flow)
-      return self.create_service_account(resource)
-    # Get a GCP Service Account
-    elif fr.method == "GET" and pcs[0] == "v1" and "iam.gserviceaccount.com" in pcs[4]:
-      resource = self.parse_get_service_account(flow)
-      return self.get_service_account(resource)
-    else:
-      return {}
-
-  def parse_post_service_account(self, flow: http.HTTPFlow) -> dict:
-    pcs = flow.request.path_components
-    data = {}
-    if flow.request.method == "POST":
-      data = flow.request.json()
-
-    uniqueId = str(random.randint(100000000000000000000, 999999999999999999999))
-    project_id = "no-project-id"
-    displayName = ""
-    description = ""
-    email = ""
-
-    if "projects" in pcs and "serviceAccounts" in pcs:
-      project_id = pcs[2]
-
-    if data.get("accountId"):
-      email = data.get("accountId") +"@"+ project_id + ".iam.gserviceaccount.com"
-
-    if data.get("serviceAccount").get("displayName"):
-      displayName = data.get("serviceAccount").get("displayName")
-
-    if data.get("serviceAccount").get("description"):
-      description = data.get("serviceAccount").get("description")
-
-    resource_name = "projects/" + project_id + "/serviceAccounts/" + email
-
-    resource = {
-      "name": resource_name,
-      "email": email,
-      "projectId": project_id,
-      "displayName": displayName,
-      "description": description,
-      "etag": "MDEwMjE5MjA=",
-      "disabled": False,
-      "oauth2ClientId": uniqueId,
-      "uniqueId": uniqueId
-    }
+  def reset_session(self, params: dict) -> dict:
+    with self.sessions_lock:
+      session = self.sessions.pop(params["session"], None)
+    if session is None:
+      return None
+    logging.info("Resetting session: "+ session.name)
+    with session.lock:
+      session.close()
+    return {"session": session.name, "assets": len(session.resources)}
 
-    return resource
-  
-  def parse_get_service_account(self, flow: http.HTTPFlow) -> dict:
-    pcs = flow.request.path_components
-    return {
-      "name": "projects/" + pcs[2] + "/serviceAccounts/" + pcs[4]
-    }
+class Router:
+  """
+  Route table for the fakers, compiled once at load time.
 
-  def create_service_account(self, resource: dict) -> dict:
-    resources["gcp_iam_serviceaccount:"+ resource.get("name")] = resource
-    return resource
+  Routes are looked up by (host, method) and then matched against the
+  url-decoded request path.  Placeholders like {project} in a template
+  become the params handed to the handler.  match() also names the route
+  that was taken ("<host> <method> <template>") for events and metrics.
 
-  def get_service_account(self, resource: dict) -> dict:
-    resource = resources.get("gcp_iam_serviceaccount:"+ resource.get("name"))
-    return resource
+  Hosts can also be claimed by a backend module (see backends.py) that
+  is only imported, and adds its routes, when its first request is seen.
+  """
+  placeholder = re.compile(r"\{(\w+)\}")
 
-class GoogleComputeFaker:
   def __init__(self) -> None:
-    self.num_count = 0
-
-  def parse(self, flow: http.HTTPFlow) -> dict:
-    fr = flow.request
-    pcs = flow.request.path_components
-
-    # Create a GCP Compute Instance
-    if fr.method == "POST" and pcs[0] == "compute" and pcs[1] == "v1" \
-      and pcs[2] == "projects" and pcs[4] == "zones" and pcs[6] == "instances":
-
-      logging.info("Creating a GCP Compute Instance")
-      # parse and store the compute instance, return the operation id
-      instance_operation_id = self.parse_post_compute_instance(flow)
-
-      # return the create instance operation
-      return self.get_instance_operation(instance_operation_id)
-
-    # Get a GCP Compute Instance Operation
-    elif fr.method == "GET" and pcs[0] == "compute" and pcs[1] == "v1" \
-      and pcs[2] == "projects" and pcs[4] == "zones":
-      if len(pcs) > 6 and pcs[6] == "operations":
-        instance_operation_id = self.parse_compute_instance_operation_for_id(flow)
-        return self.get_instance_operation(instance_operation_id)
-
-      if len(pcs) > 6 and pcs[6] == "instances":
-        logging.info("Get for GCP Compute Instance Detail")
-        instance = self.get_instance_detail(flow)
-        return instance
-
-      if len(pcs) > 6 and pcs[6] == "disks":
-        logging.info("Get for GCP Compute Instance Disk")
-        return {}
-
-
-    return None
-
-  def get_instance_detail(self, flow: http.HTTPFlow) -> dict:
-    fr = flow.request
-    pcs = flow.request.path_components
-    api_version = pcs[1]
-    project_id = pcs[3]
-    zone = pcs[5]
-    vm_name = pcs[7]
-    vm_url = "https://www.googleapis.com/compute/"+ api_version +"/projects/"+ project_id +"/zones/"+ zone +"/instances/"+ vm_name
-    instance_detail = resources.get("gcp_compute_instance:"+ vm_url)
-
-    return instance_detail
-
-  def get_instance_operation(self, operation_id: str) -> dict:
-    # return the operation by operation_id, advancing the state of the operation each time
-    logging.info("Getting a GCP Compute Instance Operation: "+ operation_id)
-    operation = compute_operations.get(operation_id)
-
-    # if pending, change to done
-    if operation.get("status") != "RUNNING" and operation.get("status") != "DONE":
-      logging.info("Setting operation to DONE: "+ operation_id)
-      operation["status"] = "DONE"
-      operation["progress"] = 100
-      operation["endTime"] = datetime.now().isoformat()
-
-    return operation
-
-  def parse_post_compute_instance(self, flow: http.HTTPFlow) -> dict:
-    fr = flow.request
-    pcs = flow.request.path_components
-    api_version = pcs[1]
-    project_id = pcs[3]
-    zone = pcs[5]
-    region = "-".join(zone.split("-")[0:2])
-    vm_name = fr.json().get('name') or "no-vm-name"
-    # parse the compute instance body from the request
-    zone_url = "https://www.googleapis.com/compute/"+ api_version +"/projects/"+ project_id +"/zones/"+ zone
-    vm_url = zone_url +"/instances/"+ vm_name
-
-    vm_id = random.randint(1000000000000000000, 9999999999999999999)
-    disk_size_gb = fr.json().get('disks')[0].get('initializeParams').get('diskSizeGb') or 10
-    tags = fr.json().get('tags').get('items')
-    can_ip_forward = fr.json().get('canIpForward')
-    service_account_email = fr.json().get('serviceAccounts')[0].get('email')
-    scopes = fr.json().get('serviceAccounts')[0].get('scopes')
-    metadata_items = fr.json().get('metadata').get('items')
-    machine_type = fr.json().get('machineType')
-    machine_type_url = "https://www.googleapis.com/compute/v1/" + machine_type
-    guest_os_features = [
-      { "type": "UEFI_COMPATIBLE" },
-      { "type": "VIRTIO_SCSI_MULTIQUEUE" },
-      { "type": "GVNIC" },
-      { "type": "SEV_CAPABLE" }
-    ]
-    architecture = fr.json().get('disks')[0].get('architecture')
-    cpu_platform = "Intel Broadwell"
-
-    instance_detail = {
-     "kind": "compute#instance",
-     "id": str(vm_id),
-     "creationTimestamp": datetime.now().isoformat(),
-     "name": vm_name,
-     "tags": {
-      "items": tags or [],
-      "fingerprint": "pOiUF0UJfOw="
-     },
-     "machineType": machine_type_url,
-     "status": "RUNNING",
-     "zone": zone_url,
-     "canIpForward": can_ip_forward or False,
-     "networkInterfaces": [],
-     "disks": [
-      {
-       "kind": "compute#attachedDisk",
-       "type": "PERSISTENT",
-       "mode": "READ_WRITE",
-       "source": zone_url +"/disks/"+ vm_name,
-       "deviceName": "persistent-disk-0",
-       "index": 0,
-       "boot": True,
-       "autoDelete": True,
-       "licenses": [
-        "https://www.googleapis.com/compute/v1/projects/debian-cloud/global/licenses/debian-12-bookworm"
-       ],
-       "interface": "SCSI",
-       "guestOsFeatures": guest_os_features or [],
-       "diskSizeGb": disk_size_gb,
-       "architecture": architecture
-      }
-     ],
-     "metadata": {
-      "kind": "compute#metadata",
-      "fingerprint": "BFuQ-sDJdpk=",
-      "items": metadata_items or []
-     },
-     "serviceAccounts": [
-      {
-       "email": service_account_email,
-       "scopes": scopes or ["https://www.googleapis.com/auth/cloud-platform"]
-      }
-     ],
-     "selfLink": vm_url,
-     "scheduling": {
-      "onHostMaintenance": "MIGRATE",
-      "automaticRestart": True,
-      "preemptible": False,
-      "provisioningModel": "STANDARD"
-     },
-     "cpuPlatform": cpu_platform,
-     "labelFingerprint": "42WmSpB8rSM=",
-     "startRestricted": False,
-     "deletionProtection": False,
-     "shieldedInstanceConfig": {
-      "enableSecureBoot": True,
-      "enableVtpm": True,
-      "enableIntegrityMonitoring": True
-     },
-     "shieldedInstanceIntegrityPolicy": {
-      "updateAutoLearnPolicy": True
-     },
-     "fingerprint": "w465_wnrOho=",
-     "lastStartTimestamp": datetime.now().isoformat()
-    }
-
-    network_interfaces = []
-    interface_count = 0
-    for req_interface in fr.json().get('networkInterfaces'):
-      network = req_interface.get('network')
-      network_name = network.split("/")[-1]
-      interface = {
-        "kind": "compute#networkInterface",
-        "network": "https://www.googleapis.com/compute/v1/projects/"+ project_id +"/global/networks/"+ network_name,
-        "subnetwork": "https://www.googleapis.com/compute/v1/projects/"+ project_id +"/regions/"+ region +"/subnetworks/"+ network_name,
-        "networkIP": "10.0.0.0",
-        "name": "nic"+ str(interface_count),
-        "fingerprint": "o9wnSWdXEW4=",
-        "stackType": "IPV4_ONLY",
-        "nicType": "gVNIC"
-      }
-      access_configs = []
-      if req_interface.get('accessConfigs')[interface_count].get('type') == "ONE_TO_ONE_NAT":
-        access_config = {
-          "kind": "compute#accessConfig",
-          "type": "ONE_TO_ONE_NAT",
-          "name": "external-nat",
-          "natIP": "1.1.1.1",
-          "networkTier": "PREMIUM"
-        }
-        access_configs.append(access_config)
-
-      interface["accessConfigs"] = access_configs
-      network_interfaces.append(interface)
-      interface_count += 1
-
-    instance_detail["networkInterfaces"] = network_interfaces
-
-    # Store the compute instance as a resource
-    resources["gcp_compute_instance:"+ vm_url] = instance_detail
-
-    # parse the project-id and zone from the path componet
-    operation_id = random.randint(1000000000000000000, 9999999999999999999)
-    target_id = random.randint(1000000000000000000, 9999999999999999999)
-    operation_name = "operation-compute-create-"+ project_id +"-"+ zone +"-"+ vm_name
-
-    # Create a new compute operation in the state of pending
-    zone_url = "https://www.googleapis.com/compute/"+ api_version +"/projects/"+ project_id +"/zones/"+ zone
-    operation = {
-     "kind": "compute#operation",
-     "id": str(operation_id),
-     "name": str(operation_name),
-     "zone": str(zone_url),
-     "operationType": "insert",
-     "targetLink": vm_url,
-     "targetId": str(target_id),
-     "status": "PENDING",
-     "user": "psychiac@psychiac.com",
-     "progress": 0,
-     "insertTime": datetime.now().isoformat(),
-     "startTime": datetime.now().isoformat(),
-     "endTime": datetime.now().isoformat(),
-     "selfLink": zone_url +"/operations/"+ operation_name
-    }
-    logging.info("Storing operation in PENDING: "+ operation_name)
-    compute_operations[operation_name] = operation
-
-    # return the operation id
-    return operation_name
-
-  def parse_compute_instance_operation_for_id(self, flow: http.HTTPFlow) -> None:
-    fr = flow.request
-    pcs = flow.request.path_components
-
-    project_id = pcs[3]
-    zone = pcs[5]
-    vm_name = fr.json().get('name') or "no-vm-name"
-
-    operation_name = "operation-compute-create-"+ project_id +"-"+ zone +"-"+ vm_name
-
-    return operation_name
-
+    self.routes = {}
+    self.fallbacks = {}
+    self.hosts = set()
+    # host -> backend module that hasn't been loaded yet
+    self.backends = {}
+    self.loading = threading.Lock()
+
+  def add(self, host: str, method: str, template: str, handler) -> None:
+    pattern = ""
+    pos = 0
+    for m in self.placeholder.finditer(template):
+      pattern += re.escape(template[pos:m.start()]) + "(?P<"+ m.group(1) +">[^/]+)"
+      pos = m.end()
+    pattern += re.escape(template[pos:])
+
+    route = host +" "+ method +" "+ template
+    self.routes.setdefault((host, method), []).append((re.compile(pattern), handler, route))
+    self.hosts.add(host)
+
+  def add_fallback(self, host: str, handler) -> None:
+    # handles any request on an owned host that no route matched
+    self.fallbacks[host] = handler
+    self.hosts.add(host)
+
+  def lazy(self, host: str, module: str) -> None:
+    self.backends[host] = module
+
+  def load(self, host: str) -> None:
+    # import the backend that owns host and have it add its routes.  The host stays
+    # claimed until it has, so flows racing the first one wait instead of skipping.
+    with self.loading:
+      module = self.backends.get(host)
+      if module is None:
+        return
+      logging.info("Loading faker backend: "+ module)
+      import_backend(module).register(self)
+      for owned in [h for h, m in self.backends.items() if m == module]:
+        del self.backends[owned]
+
+  def match(self, host: str, method: str, path: str) -> tuple:
+    # a backend's routes go in one at a time, so its hosts only count once it is no longer pending
+    if host in self.backends:
+      self.load(host)
+    if host not in self.hosts:
+      return None, None, None
+
+    path = unquote(path.split("?", 1)[0].lstrip("/"))
+    for pattern, handler, route in self.routes.get((host, method), ()):
+      m = pattern.fullmatch(path)
+      if m:
+        return handler, m.groupdict(), route
+
+    return self.fallbacks.get(host, passthrough), {}, host +" "+ method +" *"
+
+
+def import_backend(name: str):
+  # by file path, mitmproxy only has the addon's directory on sys.path while it loads the addon
+  module = sys.modules.get(name)
+  if module is None:
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ADDON_DIR, name +".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+      spec.loader.exec_module(module)
+    except BaseException:
+      del sys.modules[name]
+      raise
+  return module
+
+CONTROL_HOST = "psychiac.control"
+
+control = Router()
+control.add(CONTROL_HOST, "GET", "sessions", TerraFaker.list_sessions)
+control.add(CONTROL_HOST, "POST", "sessions/{session}", TerraFaker.open_session)
+control.add(CONTROL_HOST, "GET", "sessions/{session}/changeset", TerraFaker.get_session_changeset)
+control.add(CONTROL_HOST, "DELETE", "sessions/{session}", TerraFaker.reset_session)
+
+router = Router()
+for host, backend in BACKENDS.items():
+  router.lazy(host, backend)
 
 addons = [TerraFaker()]
@@ -0,0 +1,171 @@
+"""
+Indexed changeset archive.
+
+An alternative to changeset.json for big runs: assets are written as
+NDJSON in independently zlib-compressed chunks, with a sidecar sqlite
+index (<archive>.idx) of every asset's name, type and project and where
+it lives.  Readers memory-map the archive and only inflate the chunks
+holding the assets they ask for.
+
+List, filter, extract or convert back to changeset.json with:
+  python archive.py <archive> [list|extract|convert <changeset.json>] [type=...] [project=...] [name=...]
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import zlib
+import sqlite3
+
+from datetime import datetime
+
+PROJECT = re.compile(r"projects/([^/]+)")
+
+def asset_project(asset: dict) -> str:
+  # the project an asset belongs to, from its name or self link
+  data = asset.get("data") or {}
+  for value in (asset.get("name"), data.get("selfLink")):
+    match = PROJECT.search(value or "")
+    if match:
+      return match.group(1)
+  return data.get("projectId")
+
+class ArchiveWriter:
+  def __init__(self, path: str, chunk_assets: int = 256, chunk_bytes: int = 1 << 20) -> None:
+    self.path = path
+    self.chunk_assets = chunk_assets
+    self.chunk_bytes = chunk_bytes
+    # written aside and renamed on close, so readers never see half an archive
+    for name in (path +".tmp", path +".idx.tmp"):
+      if os.path.exists(name):
+        os.remove(name)
+    self.file = open(path +".tmp", "wb")
+    self.db = sqlite3.connect(path +".idx.tmp")
+    self.db.execute("CREATE TABLE assets (name TEXT, type TEXT, project TEXT, chunk INTEGER, slot INTEGER)")
+    self.db.execute("CREATE TABLE chunks (chunk INTEGER PRIMARY KEY, offset INTEGER, length INTEGER)")
+    self.db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    self.lines = []
+    self.rows = []
+    self.size = 0
+    self.chunk = 0
+    self.count = 0
+
+  def add(self, asset: dict) -> None:
+    line = json.dumps(asset).encode("utf-8")
+    self.rows.append((asset.get("name"), asset.get("type"), asset_project(asset), self.chunk, len(self.lines)))
+    self.lines.append(line)
+    self.size += len(line)
+    self.count += 1
+    if len(self.lines) >= self.chunk_assets or self.size >= self.chunk_bytes:
+      self.flush()
+
+  def flush(self) -> None:
+    if not self.lines:
+      return
+    data = zlib.compress(b"\n".join(self.lines), 6)
+    self.db.execute("INSERT INTO chunks VALUES (?, ?, ?)", (self.chunk, self.file.tell(), len(data)))
+    self.db.executemany("INSERT INTO assets VALUES (?, ?, ?, ?, ?)", self.rows)
+    self.file.write(data)
+    self.lines = []
+    self.rows = []
+    self.size = 0
+    self.chunk += 1
+
+  def close(self, date: str = None) -> int:
+    self.flush()
+    self.file.close()
+    self.db.execute("INSERT INTO meta VALUES ('date', ?)", (date or datetime.now().isoformat(),))
+    self.db.execute("CREATE INDEX assets_name ON assets (name)")
+    self.db.execute("CREATE INDEX assets_type ON assets (type)")
+    self.db.execute("CREATE INDEX assets_project ON assets (project)")
+    self.db.commit()
+    self.db.close()
+    os.replace(self.path +".idx.tmp", self.path +".idx")
+    os.replace(self.path +".tmp", self.path)
+    return self.count
+
+def write_archive(assets, path: str, date: str = None) -> int:
+  # write every asset of an iterable to an archive and return how many there were
+  writer = ArchiveWriter(path)
+  for asset in assets:
+    writer.add(asset)
+  return writer.close(date)
+
+class Archive:
+  def __init__(self, path: str) -> None:
+    self.db = sqlite3.connect("file:"+ path +".idx?mode=ro", uri=True)
+    self.chunks = {chunk: (offset, length) for chunk, offset, length in self.db.execute("SELECT * FROM chunks")}
+    self.date = self.db.execute("SELECT value FROM meta WHERE key = 'date'").fetchone()[0]
+    self.file = open(path, "rb")
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.chunks else b""
+    # the last chunk inflated, consecutive assets mostly share one
+    self.cached = (None, None)
+
+  def lines(self, chunk: int) -> list:
+    if self.cached[0] != chunk:
+      offset, length = self.chunks[chunk]
+      self.cached = (chunk, zlib.decompress(self.data[offset:offset + length]).split(b"\n"))
+    return self.cached[1]
+
+  def index(self, asset_type: str = None, project: str = None, name: str = None):
+    # (name, type, project, chunk, slot) of the matching assets, in archive order
+    where = []
+    args = []
+    for column, value in (("type", asset_type), ("project", project), ("name", name)):
+      if value is not None:
+        where.append(column +" = ?")
+        args.append(value)
+    query = "SELECT name, type, project, chunk, slot FROM assets"
+    if where:
+      query += " WHERE "+ " AND ".join(where)
+    return self.db.execute(query +" ORDER BY chunk, slot", args)
+
+  def assets(self, asset_type: str = None, project: str = None, name: str = None):
+    for _, _, _, chunk, slot in self.index(asset_type, project, name):
+      yield json.loads(self.lines(chunk)[slot])
+
+  def get(self, name: str) -> dict:
+    return next(self.assets(name=name), None)
+
+  def __len__(self) -> int:
+    return self.db.execute("SELECT count(*) FROM assets").fetchone()[0]
+
+  def to_changeset(self, out_path: str, **filters) -> int:
+    # write the archive (or the assets matching filters) as a changeset.json, streamed one asset at a time
+    count = 0
+    with open(out_path, "w") as outfile:
+      outfile.write('{"type": "changeset", "date": '+ json.dumps(self.date) +', "assets": [')
+      for asset in self.assets(**filters):
+        if count:
+          outfile.write(", ")
+        json.dump(asset, outfile)
+        count += 1
+      outfile.write("]}")
+    return count
+
+  def close(self) -> None:
+    if self.chunks:
+      self.data.close()
+    self.file.close()
+    self.db.close()
+
+
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if "=" not in arg]
+  filters = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+  filters = {"asset_type" if key == "type" else key: value for key, value in filters.items()}
+  if len(args) < 2 or args[1] not in ("list", "extract", "convert") or args[1] == "convert" and len(args) < 3 \
+      or set(filters) - {"asset_type", "project", "name"}:
+    print("Usage: python archive.py <archive> [list|extract|convert <changeset.json>] [type=...] [project=...] [name=...]")
+    sys.exit(1)
+  archive = Archive(args[0])
+  if args[1] == "list":
+    for name, asset_type, project, _, _ in archive.index(**filters):
+      print(asset_type, project, name)
+  elif args[1] == "extract":
+    for asset in archive.assets(**filters):
+      print(json.dumps(asset))
+  else:
+    print(str(archive.to_changeset(args[2], **filters)) +" assets written to "+ args[2])
+  archive.close()
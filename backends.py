@@ -0,0 +1,48 @@
+"""
+Registry of the cloud backends the addon fakes.
+
+A backend is a module that owns some API hosts: they are declared here,
+and the module adds its routes to the addon's router in its
+register(router) function.  Nothing of a backend is imported until a
+request for one of its hosts is first seen, so a proxy only pays the
+startup time and memory of the clouds a plan actually touches.
+
+The helpers backend handlers share live here too, so backends never
+import the addon itself.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  # only for annotations, gcp.py's builders are used by the launcher too
+  from mitmproxy import http
+
+# host -> module of the backend that fakes it
+BACKENDS = {
+  "iam.googleapis.com": "gcp",
+  "cloudresourcemanager.googleapis.com": "gcp",
+  "compute.googleapis.com": "gcp",
+  "run.googleapis.com": "gcp",
+}
+
+def flow_session(flow: http.HTTPFlow):
+  # the Session the addon picked for the flow
+  return flow.metadata["psychiac.session"]
+
+def request_json(flow: http.HTTPFlow) -> dict:
+  """
+  Decoded request body, shared by every handler that looks at the flow.
+
+  The body is only decoded the first time a handler asks for it and the
+  result is kept in the flow's metadata, so routes that never read the
+  body never pay for it.
+  """
+  data = flow.metadata.get("psychiac.json")
+  if data is None:
+    data = flow.request.json() if flow.request.content else {}
+    flow.metadata["psychiac.json"] = data
+  return data
+
+def passthrough(flow: http.HTTPFlow, params: dict) -> None:
+  return None
@@ -0,0 +1,164 @@
+"""
+Baseline of the assets that already exist, used to tell which captured
+resources the plan actually changes.
+
+The baseline is built from a Cloud Asset Inventory export (NDJSON or a
+JSON list, as written by `gcloud asset export`/`gcloud asset list`) or a
+previous changeset.json, into an sqlite index keyed the same way the
+addon keys captured resources.  Only a digest of the fields that matter
+for attack paths is kept, so ids, timestamps and fingerprints the fakers
+make up never count as a change.
+
+Build an index with: python baseline.py <export> <index.db>
+"""
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+
+VOLATILE_FIELDS = {"id", "uniqueId", "oauth2ClientId", "etag", "fingerprint", "labelFingerprint",
+                   "creationTimestamp", "lastStartTimestamp", "updateTime", "createTime", "name"}
+
+def resource_key(asset_type: str, data: dict) -> str:
+  # the key the addon stores a captured resource under, from the resource itself
+  if asset_type == "gcp_iam_serviceaccount":
+    return "projects/"+ data.get("projectId", "") +"/serviceAccounts/"+ data.get("email", "")
+  if asset_type == "gcp_compute_instance":
+    return data.get("selfLink")
+  if asset_type == "gcp_cloudresourcemanager_iam_policy":
+    return data.get("name", "").split("/")[-1]
+  return data.get("name")
+
+def last(url: str) -> str:
+  return (url or "").rsplit("/", 1)[-1]
+
+def projection(asset_type: str, data: dict):
+  # the parts of a resource that count as a change
+  if asset_type == "gcp_iam_serviceaccount":
+    return [data.get("email"), data.get("displayName") or "", data.get("description") or "", bool(data.get("disabled"))]
+
+  if asset_type == "gcp_compute_instance":
+    return {
+      "machineType": last(data.get("machineType")),
+      "tags": sorted((data.get("tags") or {}).get("items") or []),
+      "canIpForward": bool(data.get("canIpForward")),
+      "serviceAccounts": sorted([sa.get("email"), sorted(sa.get("scopes") or [])] for sa in data.get("serviceAccounts") or []),
+      "metadata": sorted([i.get("key"), i.get("value")] for i in (data.get("metadata") or {}).get("items") or []),
+      "networkInterfaces": [
+        [last(ni.get("network")), sorted(ac.get("type") or "" for ac in ni.get("accessConfigs") or [])]
+        for ni in data.get("networkInterfaces") or []
+      ],
+    }
+
+  if asset_type == "gcp_cloudresourcemanager_iam_policy":
+    return sorted([b.get("role"), sorted(b.get("members") or [])] for b in data.get("bindings") or [])
+
+  return {k: v for k, v in data.items() if k not in VOLATILE_FIELDS}
+
+def digest(asset_type: str, data: dict) -> str:
+  encoded = json.dumps(projection(asset_type, data), sort_keys=True, separators=(",", ":"))
+  return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+# Cloud Asset Inventory asset types for the resources the fakers capture
+CAI_TYPES = {
+  "iam.googleapis.com/ServiceAccount": "gcp_iam_serviceaccount",
+  "compute.googleapis.com/Instance": "gcp_compute_instance",
+  "run.googleapis.com/Service": "gcp_run_service",
+}
+
+def export_records(record: dict):
+  # yield (asset_type, key, data) for the resources in one export record
+  if "type" in record and "data" in record:
+    # an asset from a previous changeset.json
+    if record["data"] is not None:
+      yield record["type"], resource_key(record["type"], record["data"]), record["data"]
+    return
+
+  cai_type = record.get("asset_type") or record.get("assetType")
+  cai_name = record.get("name", "")
+  iam_policy = record.get("iam_policy") or record.get("iamPolicy")
+  if cai_type == "cloudresourcemanager.googleapis.com/Project" and iam_policy:
+    # CAI names projects by number, this only matches when the export uses the project id
+    yield "gcp_cloudresourcemanager_iam_policy", last(cai_name), iam_policy
+
+  asset_type = CAI_TYPES.get(cai_type)
+  data = (record.get("resource") or {}).get("data")
+  if asset_type is None or data is None:
+    return
+  if asset_type == "gcp_run_service":
+    # captured services are keyed by their v2 url
+    yield asset_type, "https://run.googleapis.com/v2/"+ cai_name.split("run.googleapis.com/", 1)[-1], data
+  else:
+    yield asset_type, resource_key(asset_type, data), data
+
+def read_export(export_path: str):
+  with open(export_path, "r") as f:
+    try:
+      doc = json.loads(f.readline())
+    except ValueError:
+      # a pretty-printed json document rather than one record per line
+      f.seek(0)
+      doc = json.load(f)
+
+    if isinstance(doc, list) or doc.get("type") == "changeset":
+      for record in doc if isinstance(doc, list) else doc.get("assets", []):
+        yield from export_records(record)
+      return
+
+    yield from export_records(doc)
+    for line in f:
+      if line.strip():
+        yield from export_records(json.loads(line))
+
+def build_index(export_path: str, db_path: str) -> int:
+  # (re)build the sqlite index for an export and return the number of resources in it
+  tmp_path = db_path +".tmp"
+  if os.path.exists(tmp_path):
+    os.remove(tmp_path)
+  db = sqlite3.connect(tmp_path)
+  db.execute("CREATE TABLE baseline (key TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+  count = 0
+  batch = []
+  for asset_type, key, data in read_export(export_path):
+    batch.append((asset_type +":"+ key, digest(asset_type, data)))
+    if len(batch) >= 10000:
+      db.executemany("INSERT OR REPLACE INTO baseline VALUES (?, ?)", batch)
+      count += len(batch)
+      batch = []
+  db.executemany("INSERT OR REPLACE INTO baseline VALUES (?, ?)", batch)
+  count += len(batch)
+  db.commit()
+  db.close()
+  os.replace(tmp_path, db_path)
+  return count
+
+class Baseline:
+  def __init__(self, path: str) -> None:
+    # an export is indexed next to itself the first time, or when it changes
+    if not path.endswith(".db"):
+      db_path = path +".db"
+      if not os.path.exists(db_path) or os.path.getmtime(db_path) < os.path.getmtime(path):
+        build_index(path, db_path)
+      path = db_path
+    self.path = path
+    self.db = sqlite3.connect("file:"+ path +"?mode=ro", uri=True, check_same_thread=False)
+
+  def classify(self, asset_type: str, key: str, data: dict) -> str:
+    # CREATE, UPDATE or NOOP for a captured resource
+    row = self.db.execute("SELECT digest FROM baseline WHERE key = ?", (asset_type +":"+ key,)).fetchone()
+    if row is None:
+      return "CREATE"
+    if row[0] != digest(asset_type, data):
+      return "UPDATE"
+    return "NOOP"
+
+  def close(self) -> None:
+    self.db.close()
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3:
+    print("Usage: python baseline.py <asset export> <index.db>")
+    sys.exit(1)
+  print(str(build_index(sys.argv[1], sys.argv[2])) +" resources indexed")
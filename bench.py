@@ -0,0 +1,342 @@
+"""
+Replay benchmark for the TerraFaker addon.
+
+Generates synthetic terraform flows for every route the addon fakes and
+drives them through the addon in-process, without a proxy or terraform.
+Reports throughput, p50/p99 latency per route, peak memory and the time
+done() takes, and can save the numbers as a baseline to compare later
+runs against.
+
+With --parallelism the same flows are also sent the way terraform
+apply -parallelism=N sends them: N resources in flight at once, each one
+a chain of calls with a round trip between them.  Every level runs with
+the flows handled inline and on the addon's worker pool, and reports the
+throughput and how long the event loop was kept from running other work.
+
+--check-scaling is the concurrency test: it fails unless throughput rises
+with each step of parallelism in SCALING_LEVELS, inline and on the pool.
+
+Usage: python bench.py [--scale 100 --scale 10000] [--parallelism 1 --parallelism 50] [--save bench.json] [--baseline bench.json]
+       python bench.py --check-scaling
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from mitmproxy import http
+from mitmproxy.test import taddons, tflow
+
+import addon
+
+USER_AGENT = "Terraform/1.8.0 (+https://www.terraform.io) terraform-provider-google/5.30.0"
+
+# parallelism levels of the scaling check, at a round trip long enough that the
+# most of them still leaves the proxy headroom on a single core
+SCALING_LEVELS = (1, 4, 16)
+SCALING_SCALE = 200
+SCALING_RTT = 0.005
+
+def make_flow(client_conn, server_conn, method, host, path, body=None):
+    content = json.dumps(body).encode("utf-8") if body is not None else b""
+    request = http.Request.make(method, f"https://{host}{path}", content,
+                                {"User-Agent": USER_AGENT, "Content-Type": "application/json"})
+    flow = http.HTTPFlow(client_conn, server_conn)
+    flow.request = request
+    return flow
+
+def instance_body(name, nics=2, metadata_items=8):
+    return {
+        "name": name,
+        "machineType": "projects/bench/zones/us-central1-a/machineTypes/e2-medium",
+        "canIpForward": False,
+        "tags": {"items": ["web", "bench"]},
+        "disks": [{"boot": True, "architecture": "X86_64",
+                   "initializeParams": {"diskSizeGb": 20, "sourceImage": "debian-cloud/debian-12"}}],
+        "serviceAccounts": [{"email": "bench@bench.iam.gserviceaccount.com",
+                             "scopes": ["https://www.googleapis.com/auth/cloud-platform"]}],
+        "metadata": {"items": [{"key": f"key-{i}", "value": f"value-{i}"} for i in range(metadata_items)]},
+        "networkInterfaces": [{"network": f"global/networks/net-{n}",
+                               "accessConfigs": [{"type": "ONE_TO_ONE_NAT"}] * nics}
+                              for n in range(nics)],
+    }
+
+def resources(scale, polls):
+    """
+    Yield, for each of `scale` resources, the list of
+    (route, method, host, path, body, follow) calls terraform makes for it.
+
+    Resources are spread round-robin over service accounts, compute
+    instances, Cloud Run services and project IAM policies.  follow turns
+    the faked response into the flows that terraform would send next.
+    """
+    zone = "us-central1-a"
+    for i in range(scale):
+        project = f"bench-{i % 50}"
+        kind = i % 4
+        if kind == 0:
+            email = f"sa-{i}@{project}.iam.gserviceaccount.com"
+            yield ([("iam.create", "POST", "iam.googleapis.com", f"/v1/projects/{project}/serviceAccounts",
+                     {"accountId": f"sa-{i}", "serviceAccount": {"displayName": f"sa {i}"}}, None)]
+                   + [("iam.get", "GET", "iam.googleapis.com",
+                       f"/v1/projects/{project}/serviceAccounts/{email}", None, None)] * polls)
+        elif kind == 1:
+            name = f"vm-{i}"
+            base = f"/compute/v1/projects/{project}/zones/{zone}"
+            yield ([("compute.insert", "POST", "compute.googleapis.com", f"{base}/instances", instance_body(name), None)]
+                   + [("compute.operation", "GET", "compute.googleapis.com",
+                       f"{base}/operations/operation-compute-create-{project}-{zone}-{name}", None, None)] * polls
+                   + [("compute.get", "GET", "compute.googleapis.com", f"{base}/instances/{name}", None, None),
+                      ("compute.disk", "GET", "compute.googleapis.com", f"{base}/disks/{name}", None, None)])
+        elif kind == 2:
+            def follow(response):
+                operation = json.loads(response.content)["name"]
+                return [("run.operation", "GET", "run.googleapis.com", f"/v2/{operation}", None, None)] * polls
+            yield [("run.patch", "PATCH", "run.googleapis.com",
+                    f"/v2/projects/{project}/locations/us-central1/services/svc-{i}?allowMissing=true",
+                    {"template": {"containers": [{"image": f"gcr.io/bench/app:{i}"}]}}, follow)]
+        else:
+            crm = "cloudresourcemanager.googleapis.com"
+            policy = {"policy": {"bindings": [{"role": "roles/viewer", "members": [f"user:u{i}@example.com"]}]}}
+            yield ([("crm.setIamPolicy", "POST", crm, f"/v1/projects/{project}:setIamPolicy", policy, None)]
+                   + [("crm.getIamPolicy", "POST", crm, f"/v1/projects/{project}:getIamPolicy", {}, None)] * polls)
+
+def scenario(scale, polls):
+    # every call of every resource, one resource after the other
+    for calls in resources(scale, polls):
+        yield from calls
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def run(scale, polls, measure_memory):
+    # drive one scenario through a fresh addon and return its numbers
+    random.seed(scale)
+    faker = addon.TerraFaker()
+    latencies = {}
+    flows = 0
+    client_conn = tflow.tclient_conn()
+    server_conn = tflow.tserver_conn()
+
+    with tempfile.TemporaryDirectory() as tmp, taddons.context(faker) as tctx:
+        tctx.configure(faker, changeset_file=os.path.join(tmp, "changeset.json"))
+        pending = list(scenario(scale, polls))
+        pending.reverse()
+        if measure_memory:
+            tracemalloc.start()
+
+        handling = 0.0
+        while pending:
+            route, method, host, path, body, follow = pending.pop()
+            flow = make_flow(client_conn, server_conn, method, host, path, body)
+            start = time.perf_counter()
+            faker.handle(flow)
+            elapsed = time.perf_counter() - start
+            handling += elapsed
+            flows += 1
+            latencies.setdefault(route, []).append(elapsed)
+            if follow is not None and flow.response is not None:
+                pending.extend(reversed(follow(flow.response)))
+
+        start = time.perf_counter()
+        faker.done()
+        done_time = time.perf_counter() - start
+
+        peak = None
+        if measure_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return {
+        "scale": scale,
+        "flows": flows,
+        "throughput": flows / handling,
+        "done_s": done_time,
+        "peak_mb": None if peak is None else peak / 2 ** 20,
+        "routes": {route: {"count": len(samples),
+                           "p50_us": percentile(samples, 0.50) * 1e6,
+                           "p99_us": percentile(samples, 0.99) * 1e6}
+                   for route, samples in sorted(latencies.items())},
+    }
+
+async def drive(scale, polls, parallelism, workers, rtt):
+    # send the scenario with `parallelism` resources in flight, like terraform apply -parallelism
+    random.seed(scale)
+    faker = addon.TerraFaker()
+    client_conn = tflow.tclient_conn()
+    server_conn = tflow.tserver_conn()
+    chains = resources(scale, polls)
+    flows = 0
+    lags = []
+
+    async def terraform():
+        # one of terraform's walkers, taking the next resource when it is done with one
+        nonlocal flows
+        for calls in chains:
+            pending = list(reversed(calls))
+            while pending:
+                route, method, host, path, body, follow = pending.pop()
+                flow = make_flow(client_conn, server_conn, method, host, path, body)
+                await faker.request(flow)
+                flows += 1
+                if follow is not None and flow.response is not None:
+                    pending.extend(reversed(follow(flow.response)))
+                await asyncio.sleep(rtt)
+
+    async def ticker():
+        # how late the event loop gets around to a 1ms timer is how long it was kept busy
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    with tempfile.TemporaryDirectory() as tmp, taddons.context(faker) as tctx:
+        tctx.configure(faker, changeset_file=os.path.join(tmp, "changeset.json"), workers=workers)
+        tick = asyncio.create_task(ticker())
+        start = time.perf_counter()
+        await asyncio.gather(*(terraform() for _ in range(parallelism)))
+        elapsed = time.perf_counter() - start
+        tick.cancel()
+        faker.done()
+
+    return {
+        "parallelism": parallelism,
+        "workers": workers,
+        "flows": flows,
+        "throughput": flows / elapsed,
+        "lag_p99_ms": percentile(lags, 0.99) * 1000 if lags else 0.0,
+        "lag_max_ms": max(lags, default=0.0) * 1000,
+    }
+
+def report_concurrency(results, baseline=None, threshold=0.10):
+    regressions = []
+    old = {(r["parallelism"], r["workers"]): r for r in baseline or []}
+    print(f"  {'parallelism':>11}{'workers':>9}{'flows/s':>11}{'lag p99 ms':>12}{'lag max ms':>12}")
+    for result in results:
+        line = (f"  {result['parallelism']:>11}{result['workers']:>9}{result['throughput']:>11,.0f}"
+                f"{result['lag_p99_ms']:>12.2f}{result['lag_max_ms']:>12.2f}")
+        previous = old.get((result["parallelism"], result["workers"]))
+        if previous:
+            change = (result["throughput"] - previous["throughput"]) / previous["throughput"]
+            line += f" ({change:+.0%}{' REGRESSION' if -change > threshold else ''})"
+            if -change > threshold:
+                regressions.append(f"parallelism {result['parallelism']} workers {result['workers']}")
+        print(line)
+    return regressions
+
+def check_scaling(polls, workers, threshold=0.10):
+    # run the scaling check and return what failed it: a level that didn't beat the one
+    # below it by more than threshold
+    failures = []
+    print(f"scaling at scale {SCALING_SCALE}, {SCALING_RTT * 1000:g}ms round trip")
+    print(f"  {'parallelism':>11}{'workers':>9}{'flows/s':>11}{'lag p99 ms':>12}")
+    for pool in (0, workers):
+        previous = None
+        for parallelism in SCALING_LEVELS:
+            result = asyncio.run(drive(SCALING_SCALE, polls, parallelism, pool, SCALING_RTT))
+            print(f"  {parallelism:>11}{pool:>9}{result['throughput']:>11,.0f}{result['lag_p99_ms']:>12.2f}")
+            if previous is not None and result["throughput"] <= previous["throughput"] * (1 + threshold):
+                failures.append(f"workers {pool}: {previous['throughput']:,.0f} flows/s at parallelism "
+                                f"{previous['parallelism']}, {result['throughput']:,.0f} at {parallelism}")
+            previous = result
+    return failures
+
+def report(result, baseline=None, threshold=0.10):
+    # print one scale's numbers, marking anything worse than the baseline by more than threshold
+    regressions = []
+    def compare(name, value, old, higher_is_better=False):
+        if old is None or value is None or not old:
+            return ""
+        change = (value - old) / old
+        worse = -change if higher_is_better else change
+        if worse > threshold:
+            regressions.append(name)
+        return f" ({change:+.0%}{' REGRESSION' if worse > threshold else ''})"
+
+    old = baseline or {}
+    print(f"scale {result['scale']}: {result['flows']} flows")
+    print(f"  throughput  {result['throughput']:,.0f} flows/s"
+          + compare("throughput", result["throughput"], old.get("throughput"), True))
+    print(f"  done()      {result['done_s'] * 1000:,.1f} ms" + compare("done", result["done_s"], old.get("done_s")))
+    if result["peak_mb"] is not None:
+        print(f"  peak memory {result['peak_mb']:,.1f} MiB" + compare("memory", result["peak_mb"], old.get("peak_mb")))
+    print(f"  {'route':<20}{'count':>9}{'p50 us':>10}{'p99 us':>10}")
+    for route, stats in result["routes"].items():
+        old_stats = old.get("routes", {}).get(route, {})
+        print(f"  {route:<20}{stats['count']:>9}{stats['p50_us']:>10.1f}{stats['p99_us']:>10.1f}"
+              + compare(route + " p50", stats["p50_us"], old_stats.get("p50_us")))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TerraFaker addon with synthetic flows")
+    parser.add_argument("--scale", type=int, action="append",
+                        help="number of resources to create, repeatable (default: 100, 1000, 10000)")
+    parser.add_argument("--polls", type=int, default=3, help="operation polls / re-reads per resource")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the tracemalloc pass that measures peak memory")
+    parser.add_argument("--parallelism", type=int, action="append",
+                        help="also send the flows with this many resources in flight, repeatable")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="addon worker threads for the --parallelism runs (default: 8)")
+    parser.add_argument("--rtt", type=float, default=1.0,
+                        help="milliseconds terraform takes between a response and its next call (default: 1)")
+    parser.add_argument("--check-scaling", action="store_true",
+                        help="only check that throughput rises with parallelism, inline and on the worker pool, "
+                             "and fail if it doesn't")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative slowdown that counts as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    if args.check_scaling:
+        failures = check_scaling(args.polls, args.workers, args.threshold)
+        if failures:
+            print("Throughput did not scale with parallelism: " + "; ".join(failures))
+            sys.exit(1)
+        return
+
+    baselines = {}
+    concurrency_baseline = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baselines = {str(r["scale"]): r for r in saved["results"]}
+        concurrency_baseline = saved.get("concurrency", [])
+
+    results = []
+    regressions = []
+    for scale in args.scale or [100, 1000, 10000]:
+        result = run(scale, args.polls, False)
+        if args.memory:
+            # tracemalloc slows every allocation, so memory gets a pass of its own
+            result["peak_mb"] = run(scale, args.polls, True)["peak_mb"]
+        results.append(result)
+        regressions += report(result, baselines.get(str(scale)), args.threshold)
+
+    concurrency = []
+    if args.parallelism:
+        scale = max(args.scale or [1000])
+        print(f"concurrency at scale {scale}, {args.rtt:g}ms round trip")
+        for parallelism in args.parallelism:
+            for workers in (0, args.workers):
+                concurrency.append(asyncio.run(drive(scale, args.polls, parallelism, workers, args.rtt / 1000)))
+        regressions += report_concurrency(concurrency, concurrency_baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "polls": args.polls, "results": results,
+                       "concurrency": concurrency}, f, indent=2)
+
+    if regressions:
+        print("Regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
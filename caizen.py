@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import zlib
+import queue
+import random
+import hashlib
+import tempfile
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+
+# responses worth trying again, anything else is returned to the caller as is
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# fields that differ between two captures of the same plan: capture times, and the ids
+# and timestamps the fakers make up for every resource
+VOLATILE_CHANGESET = {"date"}
+VOLATILE_ASSET = {"update_time"}
+VOLATILE_DATA = {"id", "uniqueId", "oauth2ClientId", "creationTimestamp", "lastStartTimestamp"}
+
+def canonical_changeset(changeset):
+    # the changeset as compact json with sorted keys and assets, and without its volatile fields
+    assets = []
+    for asset in changeset.get("assets", []):
+        asset = {k: v for k, v in asset.items() if k not in VOLATILE_ASSET}
+        if isinstance(asset.get("data"), dict):
+            asset["data"] = {k: v for k, v in asset["data"].items() if k not in VOLATILE_DATA}
+        assets.append(json.dumps(asset, sort_keys=True, separators=(",", ":")))
+    assets.sort()
+    rest = {k: v for k, v in changeset.items() if k not in VOLATILE_CHANGESET and k != "assets"}
+    head = json.dumps(rest, sort_keys=True, separators=(",", ":"))
+    return (head +"\n"+ "\n".join(assets)).encode("utf-8")
+
+def changeset_digest(changeset, *context):
+    # same digest for every capture of the same plan, context (e.g. the CAIZEN url) is hashed along
+    digest = hashlib.sha256(canonical_changeset(changeset))
+    for value in context:
+        digest.update(b"\0"+ str(value).encode("utf-8"))
+    return digest.hexdigest()
+
+def encode_changeset(changeset, compress=True, chunk_size=64 * 1024):
+    # Stream the changeset out as (gzipped) json chunks instead of building the whole body
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    pieces = []
+    size = 0
+    for piece in json.JSONEncoder().iterencode(changeset):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            chunk = "".join(pieces).encode("utf-8")
+            pieces = []
+            size = 0
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+
+    chunk = "".join(pieces).encode("utf-8")
+    if compressor is not None:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    yield chunk
+
+class CaizenClient:
+    """
+    Submits changesets to CAIZEN over one pooled session.
+
+    Bodies are streamed and gzipped, every request has a timeout, and
+    connection errors or 429/5xx responses are retried a bounded number
+    of times with exponential backoff.
+
+    Besides submitting a whole changeset, assets can be sent ahead to a
+    staging session under <url>/staging and analyzed by committing it.
+    """
+    def __init__(self, url, compress=True, retries=3, backoff=0.5, timeout=(5, 300)):
+        self.url = url
+        self.compress = compress
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+    def post(self, url, changeset):
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+
+        for attempt in range(self.retries + 1):
+            last_try = attempt == self.retries
+            try:
+                # the body is a generator, so it is re-encoded for every attempt
+                response = self.session.post(url, data=encode_changeset(changeset, self.compress),
+                                             headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_try:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last_try:
+                    response.raise_for_status()
+                    return response
+            time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    def submit(self, changeset):
+        # send a changeset for analysis and return CAIZEN's response
+        return self.post(self.url, changeset).json()
+
+    def staging_url(self, *path):
+        return "/".join((self.url.rstrip("/"), "staging") + path)
+
+    def open_staging(self):
+        # start a staging session and return its id
+        return self.post(self.staging_url(), {}).json()["id"]
+
+    def stage(self, staging_id, assets):
+        # staging upserts by (type, name), so sending an asset again (or retrying a batch) is harmless
+        self.post(self.staging_url(staging_id, "assets"), {"assets": assets})
+
+    def commit(self, staging_id, head):
+        # analyze everything staged as one changeset, head has its other fields, and return CAIZEN's response
+        return self.post(self.staging_url(staging_id, "commit"), head).json()
+
+    def abort(self, staging_id):
+        self.session.delete(self.staging_url(staging_id), timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+class StagedSubmission:
+    """
+    A changeset sent to a CAIZEN staging session while it is being captured.
+
+    Assets are handed to add() from any thread and sent by a background
+    thread in batches of batch_size, or whatever is waiting every interval
+    seconds.  A later asset for the same (type, name) replaces the staged
+    one, as in the merged changeset.  If a batch can't be sent, staging
+    stops and commit() raises, so the caller can submit the changeset
+    whole instead.
+    """
+    def __init__(self, client, batch_size=500, interval=2.0):
+        self.client = client
+        self.batch_size = batch_size
+        self.interval = interval
+        self.staging_id = client.open_staging()
+        self.queue = queue.SimpleQueue()
+        self.error = None
+        self.staged = 0
+        self.thread = threading.Thread(target=self.ship, name="caizen-staging", daemon=True)
+        self.thread.start()
+
+    def add(self, assets):
+        self.queue.put(list(assets))
+
+    def ship(self):
+        batch = []
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                assets = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                assets = []
+            if assets is None:
+                self.send(batch)
+                return
+            batch.extend(assets)
+            while len(batch) >= self.batch_size:
+                self.send(batch[:self.batch_size])
+                batch = batch[self.batch_size:]
+            if time.monotonic() >= deadline:
+                self.send(batch)
+                batch = []
+                deadline = time.monotonic() + self.interval
+
+    def send(self, batch):
+        if not batch or self.error is not None:
+            return
+        try:
+            self.client.stage(self.staging_id, batch)
+            self.staged += len(batch)
+        except requests.RequestException as e:
+            self.error = e
+
+    def close(self):
+        # send what is still queued and stop the thread
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def commit(self, changeset):
+        self.close()
+        if self.error is not None:
+            raise self.error
+        return self.client.commit(self.staging_id, {k: v for k, v in changeset.items() if k != "assets"})
+
+    def abort(self):
+        self.close()
+        try:
+            self.client.abort(self.staging_id)
+        except requests.RequestException:
+            pass
+
+class ResultCache:
+    """
+    CAIZEN responses on disk, one json file per changeset digest.
+
+    A hit refreshes the entry's mtime, and once the directory grows past
+    max_bytes the least recently used entries are evicted.
+    """
+    def __init__(self, path, max_bytes=256 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def entry(self, key):
+        return os.path.join(self.path, key +".json")
+
+    def get(self, key):
+        try:
+            with open(self.entry(key), "r") as f:
+                response = json.load(f)
+            os.utime(self.entry(key))
+        except (OSError, ValueError):
+            return None
+        return response
+
+    def put(self, key, response):
+        # written aside and renamed, so concurrent runs never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(response, f)
+        os.replace(tmp_path, self.entry(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+def print_result(response):
+    # same output as `jq -r '.result'`
+    result = response.get("result")
+    if isinstance(result, str):
+        print(result)
+    else:
+        print(json.dumps(result, indent=2))
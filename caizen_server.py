@@ -0,0 +1,166 @@
+"""
+Local stand-in for the CAIZEN API, to run psychiac against without a CAIZEN deployment.
+
+Serves the changeset endpoint psychiac submits to and the staging API of
+--incremental under it:
+
+  POST   /changeset                      a whole changeset, answers the analysis
+  POST   /changeset/staging              opens a staging session, answers {"id": ...}
+  POST   /changeset/staging/<id>/assets  {"assets": [...]}, upserted by (type, name)
+  POST   /changeset/staging/<id>/commit  the changeset's other fields, answers the analysis
+  DELETE /changeset/staging/<id>         drops a staging session
+
+Bodies may be gzipped.  The analysis only counts the assets by type and
+action and digests the changeset, so a staged and a whole submission of
+the same capture can be compared.  --ingest-ms and --analysis-ms add
+processing time like CAIZEN's.
+
+Run with: python caizen_server.py [--port 8000] [--ingest-ms 0] [--analysis-ms 0]
+"""
+import json
+import time
+import uuid
+import zlib
+import argparse
+import threading
+import collections
+
+from caizen import changeset_digest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StandIn:
+    def __init__(self, ingest_ms=0.0, analysis_ms=0.0):
+        self.ingest = ingest_ms / 1000
+        self.analysis = analysis_ms / 1000
+        self.lock = threading.Lock()
+        # staging id -> {(type, name): asset}
+        self.staging = {}
+
+    def open(self):
+        staging_id = uuid.uuid4().hex
+        with self.lock:
+            self.staging[staging_id] = {}
+        return {"id": staging_id}
+
+    def stage(self, staging_id, assets):
+        time.sleep(self.ingest * len(assets))
+        with self.lock:
+            staged = self.staging[staging_id]
+            for asset in assets:
+                key = (asset.get("type"), asset.get("name"))
+                staged.pop(key, None)
+                staged[key] = asset
+            return {"staged": len(staged)}
+
+    def commit(self, staging_id, head):
+        with self.lock:
+            staged = self.staging.pop(staging_id)
+        return self.analyze(dict(head, assets=list(staged.values())))
+
+    def abort(self, staging_id):
+        with self.lock:
+            del self.staging[staging_id]
+        return {}
+
+    def submit(self, changeset):
+        time.sleep(self.ingest * len(changeset.get("assets", [])))
+        return self.analyze(changeset)
+
+    def analyze(self, changeset):
+        time.sleep(self.analysis)
+        assets = changeset.get("assets", [])
+        return {"result": {
+            "assets": len(assets),
+            "types": dict(collections.Counter(asset.get("type") for asset in assets)),
+            "actions": dict(collections.Counter(asset.get("action") for asset in assets)),
+            "digest": changeset_digest(changeset),
+        }}
+
+def handler(standin, prefix="/changeset"):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, psychiac's client pools its connections
+        protocol_version = "HTTP/1.1"
+
+        def read_body(self):
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    if not size:
+                        break
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                # trailers, up to the blank line
+                while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                body = b"".join(chunks)
+            else:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding", "").lower() == "gzip":
+                body = zlib.decompress(body, 47)
+            return json.loads(body) if body else {}
+
+        def reply(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def route(self, method):
+            path = self.path.split("?", 1)[0].rstrip("/")
+            if not path.startswith(prefix):
+                return self.reply(404, {"error": "not found"})
+            parts = path[len(prefix):].strip("/").split("/") if path != prefix else []
+            try:
+                body = self.read_body() if method == "POST" else {}
+            except ValueError as e:
+                return self.reply(400, {"error": str(e)})
+            try:
+                if method == "POST" and parts == []:
+                    return self.reply(200, standin.submit(body))
+                if method == "POST" and parts == ["staging"]:
+                    return self.reply(200, standin.open())
+                if method == "POST" and len(parts) == 3 and parts[0] == "staging" and parts[2] == "assets":
+                    return self.reply(200, standin.stage(parts[1], body.get("assets", [])))
+                if method == "POST" and len(parts) == 3 and parts[0] == "staging" and parts[2] == "commit":
+                    return self.reply(200, standin.commit(parts[1], body))
+                if method == "DELETE" and len(parts) == 2 and parts[0] == "staging":
+                    return self.reply(200, standin.abort(parts[1]))
+            except KeyError:
+                return self.reply(404, {"error": "no such staging session"})
+            return self.reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            self.route("POST")
+
+        def do_DELETE(self):
+            self.route("DELETE")
+
+        def log_message(self, format, *args):
+            print(self.address_string(), format % args)
+
+    return Handler
+
+def serve(port=8000, ingest_ms=0.0, analysis_ms=0.0, host="127.0.0.1"):
+    # start the stand-in on a background thread and return the server, shutdown() stops it
+    server = ThreadingHTTPServer((host, port), handler(StandIn(ingest_ms, analysis_ms)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the CAIZEN changeset API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--ingest-ms", type=float, default=0.0,
+                        help="time taken per asset received, whole or staged (default: 0)")
+    parser.add_argument("--analysis-ms", type=float, default=0.0,
+                        help="time taken per analysis (default: 0)")
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler(StandIn(args.ingest_ms, args.analysis_ms)))
+    print(f"CAIZEN stand-in listening on http://127.0.0.1:{args.port}/changeset")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
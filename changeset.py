@@ -0,0 +1,134 @@
+"""
+Changeset assets and the append-only changeset log.
+
+Captured assets are written as one JSON record per line while Terraform
+is still running, then compacted into the changeset.json shape that
+CAIZEN expects.  If the proxy dies mid-run, the log on disk can still be
+compacted into a partial changeset.
+
+make_asset turns a captured or plan-built resource into an asset, for
+the proxy and the launcher alike, so nothing here needs mitmproxy.
+"""
+import os
+import json
+import time
+
+from datetime import datetime
+from baseline import Baseline
+
+def make_asset(asset_type: str, key: str, resource: dict, baseline: Baseline = None, keep_noop_data: bool = False) -> dict:
+  asset = {
+    "name": resource.get("name"),
+    "type": asset_type,
+    "action": "UPSERT",
+    "update_time": datetime.now().isoformat(),
+    "data": resource
+  }
+  # with a baseline, say what the plan does to the resource
+  if baseline is not None:
+    asset["action"] = baseline.classify(asset_type, key, resource)
+    if asset["action"] == "NOOP" and not keep_noop_data:
+      del asset["data"]
+  return asset
+
+class ChangesetLog:
+  def __init__(self, path: str, sync_every: int = 64, sync_interval: float = 1.0) -> None:
+    self.path = path
+    self.sync_every = sync_every
+    self.sync_interval = sync_interval
+    self.pending = 0
+    self.last_sync = time.monotonic()
+    # a new proxy starts with nothing captured, so neither does its log
+    self.file = open(path, "w")
+
+  def append(self, key: str, asset: dict) -> None:
+    # key identifies the resource, later records for the same key win
+    self.file.write(json.dumps({"key": key, "asset": asset}) + "\n")
+    self.pending += 1
+    if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+      self.sync()
+
+  def sync(self) -> None:
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.pending = 0
+    self.last_sync = time.monotonic()
+
+  def close(self) -> None:
+    if not self.file.closed:
+      self.sync()
+      self.file.close()
+
+
+def read_log(log_path: str):
+  # yield (key, asset) for every complete record, a torn last line is dropped
+  with open(log_path, "r") as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      yield record["key"], record["asset"]
+
+class LogTail:
+  """
+  Follows a changeset log the proxy is still appending to.
+
+  read() returns the (key, asset) records completed since the last call,
+  a line still being written is kept for the next one.  A log that
+  doesn't exist yet reads as empty.
+  """
+  def __init__(self, path: str) -> None:
+    self.path = path
+    self.offset = 0
+    self.partial = b""
+
+  def read(self) -> list:
+    try:
+      with open(self.path, "rb") as f:
+        f.seek(self.offset)
+        data = f.read()
+    except FileNotFoundError:
+      return []
+    self.offset += len(data)
+    lines = (self.partial + data).split(b"\n")
+    self.partial = lines.pop()
+    records = []
+    for line in lines:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      records.append((record["key"], record["asset"]))
+    return records
+
+def compacted(log_path: str, omit_noops: bool = False):
+  """
+  Yield the assets of the compacted log, one at a time.
+
+  Only the last record for each key is kept, and dropped entirely if it
+  is a NOOP against the baseline and omit_noops is set.  Memory is
+  bounded by the number of keys, not asset sizes.
+  """
+  last = {}
+  for i, (key, _) in enumerate(read_log(log_path)):
+    last[key] = i
+
+  for i, (key, asset) in enumerate(read_log(log_path)):
+    if last[key] != i or omit_noops and asset.get("action") == "NOOP":
+      continue
+    yield asset
+
+def compact_log(log_path: str, out_path: str, omit_noops: bool = False) -> int:
+  # Compact the log into a changeset.json file, streamed out, and return the asset count
+  count = 0
+  with open(out_path, "w") as outfile:
+    outfile.write('{"type": "changeset", "date": '+ json.dumps(datetime.now().isoformat()) +', "assets": [')
+    for asset in compacted(log_path, omit_noops):
+      if count:
+        outfile.write(", ")
+      json.dump(asset, outfile)
+      count += 1
+    outfile.write("]}")
+
+  return count
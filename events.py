@@ -0,0 +1,84 @@
+"""
+Structured event log for the addon.
+
+Events have a fixed schema (event, route, key, action, latency) and are
+level gated before anything is built.  They always go to an in-memory
+ring buffer that can be dumped when something fails, and optionally to
+an NDJSON file written by a background thread, so flow handling never
+waits on the disk.  Request bodies are only attached at debug level, and
+then only for a sample of the flows.
+"""
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import collections
+
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warn": logging.WARNING, "error": logging.ERROR}
+
+FIELDS = ("ts", "level", "event", "route", "key", "action", "latency_ms", "body")
+
+class EventLog:
+  def __init__(self, path: str = "", level: str = "info", ring_size: int = 1024, body_sample: int = 0) -> None:
+    self.level = LEVELS[level]
+    self.ring = collections.deque(maxlen=ring_size)
+    # attach one request body in every body_sample debug events, 0 for never
+    self.body_sample = body_sample
+    self.queue = None
+    self.thread = None
+    if path:
+      self.queue = queue.SimpleQueue()
+      self.thread = threading.Thread(target=self.write, args=(path,), name="psychiac-events", daemon=True)
+      self.thread.start()
+
+  def enabled(self, level: int) -> bool:
+    return level >= self.level
+
+  def wants_body(self) -> bool:
+    return self.level <= logging.DEBUG and self.body_sample > 0 and random.randrange(self.body_sample) == 0
+
+  def emit(self, level: int, event: str, route: str = "", key: str = "", action: str = "",
+           latency: float = 0.0, body: bytes = None) -> None:
+    if level < self.level:
+      return
+    record = (time.time(), level, event, route, key, action, round(latency * 1000, 3), body)
+    self.ring.append(record)
+    if self.queue is not None:
+      self.queue.put(record)
+
+  def write(self, path: str) -> None:
+    # runs on the writer thread, a None record means close
+    with open(path, "a") as f:
+      while True:
+        records = [self.queue.get()]
+        while not self.queue.empty() and len(records) < 512:
+          records.append(self.queue.get())
+        for record in records:
+          if record is None:
+            return
+          f.write(encode(record) +"\n")
+        f.flush()
+
+  def dump(self, path: str) -> None:
+    # write out the most recent events, e.g. after a handler failed
+    with open(path, "w") as f:
+      for record in list(self.ring):
+        f.write(encode(record) +"\n")
+
+  def close(self) -> None:
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+      self.queue = None
+
+def encode(record: tuple) -> str:
+  event = dict(zip(FIELDS, record))
+  event["level"] = logging.getLevelName(event["level"]).lower()
+  if event["body"] is None:
+    del event["body"]
+  else:
+    event["body"] = event["body"].decode("utf-8", "replace")
+  return json.dumps(event)
@@ -0,0 +1,428 @@
+"""
+Google Cloud backend: fakes IAM service accounts, project IAM policies,
+compute instances and Cloud Run services.
+
+Handlers can run on several of the addon's worker threads at once.  They
+decode and build resources without holding anything and only take the
+session's lock to change its stores.
+"""
+from __future__ import annotations
+
+import logging
+import random
+
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from backends import flow_session, passthrough, request_json
+from store import Record, ResourceStore
+
+if TYPE_CHECKING:
+  # only for annotations: backends never import the addon, and the launcher builds
+  # plan assets with them where mitmproxy may not be installed
+  from addon import Session
+  from mitmproxy import http
+
+class GoogleRunFaker:
+  def __init__(self) -> None:
+    self.num_count = 0
+
+  def patch_service(self, flow: http.HTTPFlow, params: dict) -> Record:
+    # parse and store the cloudrun , return the operation id
+    run_operation_id = self.parse_patch_run(flow, params)
+
+    # return the create instance operation
+    return self.get_run_operation(flow_session(flow), run_operation_id)
+
+  def get_operation(self, flow: http.HTTPFlow, params: dict) -> Record:
+    run_operation_id = "projects/"+ params["project"] +"/locations/"+ params["location"] +"/operations/"+ params["name"]
+    session = flow_session(flow)
+    if ("run", run_operation_id) not in session.operations:
+      return None
+    return self.get_run_operation(session, run_operation_id)
+
+  def parse_patch_run(self, flow: http.HTTPFlow, params: dict) -> str:
+    session = flow_session(flow)
+    project_id = params["project"]
+    location = params["location"]
+    # parse the run instance body from the request
+    run_url, run_detail = self.build_service(params["version"], project_id, location, params["name"], request_json(flow))
+
+    # Store the cloudrun service as a resource
+    session.capture("gcp_run_service", run_url, run_detail)
+
+    # Create a new run operation, named the way terraform will poll for it
+    operation_id = random.randint(1000000000000000000, 9999999999999999999)
+    operation_name = "projects/"+ project_id +"/locations/"+ location +"/operations/"+ str(operation_id)
+    operation = {
+      "name": operation_name
+    }
+
+    logging.info("Storing operation in PENDING: "+ operation_name)
+    with session.lock:
+      session.operations.put("run", operation_name, operation)
+
+    # return the operation id
+    return operation_name
+
+  def build_service(self, api_version: str, project_id: str, location: str, svc_name: str, body: dict) -> tuple:
+    # (key, resource) of the service a PATCH with this body creates
+    run_url = "https://run.googleapis.com/"+ api_version +"/projects/"+ project_id +"/locations/"+ location +"/services/"+ svc_name
+    run_detail = dict(body)
+    run_detail["name"] = run_url
+    return run_url, run_detail
+
+  def get_run_operation(self, session: "Session", operation_id: str) -> Record:
+    # return the operation by operation_id, advancing the state of the operation each time
+    logging.info("Getting a Cloud Run Operation: "+ operation_id)
+    with session.lock:
+      operation = session.operations.record("run", operation_id)
+
+      # if pending, change to done
+      if operation.data.get("done") is None:
+        logging.info("Setting operation to DONE: "+ operation_id)
+        operation.data["done"] = True
+        session.operations.touch(operation)
+
+    return operation
+
+
+class GoogleCrmFaker:
+  def __init__(self) -> None:
+    self.num_count = 0
+
+  def get_iam_policy(self, flow: http.HTTPFlow, params: dict) -> Record:
+    project_id = params["project"]
+    policy = flow_session(flow).resources.record("gcp_cloudresourcemanager_iam_policy", project_id)
+    # if we've already created an IAM policy for this project, return it
+    if policy is not None:
+      logging.info("Fetching IAM policy for project: "+ project_id)
+      return policy
+    # else allow the request to go through
+    else:
+      logging.info("Storing IAM policy for project: "+ project_id)
+      return None
+
+  def set_iam_policy(self, flow: http.HTTPFlow, params: dict) -> Record:
+    session = flow_session(flow)
+    project_id = params["project"]
+    # parse the iam policy from the request body, a copy as the decoded body is shared
+    policy = dict(request_json(flow))
+    policy['version'] = 1
+    policy['etag'] = "BwYR2wZdArY="
+    if policy.get('policy') is None:
+      return None
+
+    record = session.capture("gcp_cloudresourcemanager_iam_policy", project_id,
+                             self.build_policy(project_id, policy.get('policy')))
+    logging.info("Returning IAM policy for project: "+ project_id)
+    return record
+
+  def build_policy(self, project_id: str, policy: dict) -> dict:
+    # the project policy a setIamPolicy with this policy leaves behind
+    return dict(policy, name="projects/"+ project_id)
+
+class GoogleIamFaker:
+
+  def __init__(self) -> None:
+    self.num_count = 0
+
+  def post_service_account(self, flow: http.HTTPFlow, params: dict) -> Record:
+    resource = self.parse_post_service_account(flow, params)
+    return self.create_service_account(flow_session(flow), resource)
+
+  def get_service_account_detail(self, flow: http.HTTPFlow, params: dict) -> Record:
+    resource = self.parse_get_service_account(flow, params)
+    return self.get_service_account(flow_session(flow), resource)
+
+  def parse_post_service_account(self, flow: http.HTTPFlow, params: dict) -> dict:
+    return self.build_service_account(params["project"], request_json(flow))
+
+  def build_service_account(self, project_id: str, data: dict) -> dict:
+    # the service account a create request with this body returns
+    uniqueId = str(random.randint(100000000000000000000, 999999999999999999999))
+    displayName = ""
+    description = ""
+    email = ""
+
+    if data.get("accountId"):
+      email = data.get("accountId") +"@"+ project_id + ".iam.gserviceaccount.com"
+
+    if data.get("serviceAccount").get("displayName"):
+      displayName = data.get("serviceAccount").get("displayName")
+
+    if data.get("serviceAccount").get("description"):
+      description = data.get("serviceAccount").get("description")
+
+    resource_name = "projects/" + project_id + "/serviceAccounts/" + email
+
+    resource = {
+      "name": resource_name,
+      "email": email,
+      "projectId": project_id,
+      "displayName": displayName,
+      "description": description,
+      "etag": "MDEwMjE5MjA=",
+      "disabled": False,
+      "oauth2ClientId": uniqueId,
+      "uniqueId": uniqueId
+    }
+
+    return resource
+
+  def parse_get_service_account(self, flow: http.HTTPFlow, params: dict) -> dict:
+    return {
+      "name": "projects/" + params["project"] + "/serviceAccounts/" + params["name"]
+    }
+
+  def create_service_account(self, session: "Session", resource: dict) -> Record:
+    return session.capture("gcp_iam_serviceaccount", resource.get("name"), resource)
+
+  def get_service_account(self, session: "Session", resource: dict) -> Record:
+    return session.resources.record("gcp_iam_serviceaccount", resource.get("name"))
+
+# shared by every faked instance, never mutate these
+GUEST_OS_FEATURES = [
+  { "type": "UEFI_COMPATIBLE" },
+  { "type": "VIRTIO_SCSI_MULTIQUEUE" },
+  { "type": "GVNIC" },
+  { "type": "SEV_CAPABLE" }
+]
+DEBIAN_12_LICENSES = [
+  "https://www.googleapis.com/compute/v1/projects/debian-cloud/global/licenses/debian-12-bookworm"
+]
+DEFAULT_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+class GoogleComputeFaker:
+  def __init__(self) -> None:
+    self.num_count = 0
+
+  def post_instance(self, flow: http.HTTPFlow, params: dict) -> Record:
+    logging.info("Creating a GCP Compute Instance")
+    # parse and store the compute instance, return the operation id
+    instance_operation_id = self.parse_post_compute_instance(flow, params)
+
+    # return the create instance operation
+    return self.get_instance_operation(flow_session(flow), instance_operation_id)
+
+  def get_operation(self, flow: http.HTTPFlow, params: dict) -> Record:
+    session = flow_session(flow)
+    if ("compute", params["name"]) not in session.operations:
+      return None
+    return self.get_instance_operation(session, params["name"])
+
+  def get_disk(self, flow: http.HTTPFlow, params: dict) -> Record:
+    # disks aren't faked yet, the real API answers
+    logging.info("Get for GCP Compute Instance Disk")
+    return None
+
+  def get_instance_detail(self, flow: http.HTTPFlow, params: dict) -> Record:
+    logging.info("Get for GCP Compute Instance Detail")
+    vm_url = "https://www.googleapis.com/compute/"+ params["version"] +"/projects/"+ params["project"] +"/zones/"+ params["zone"] +"/instances/"+ params["name"]
+    instance_detail = flow_session(flow).resources.record("gcp_compute_instance", vm_url)
+
+    return instance_detail
+
+  def get_instance_operation(self, session: "Session", operation_id: str) -> Record:
+    # return the operation by operation_id, advancing the state of the operation each time
+    logging.info("Getting a GCP Compute Instance Operation: "+ operation_id)
+    with session.lock:
+      operation = session.operations.record("compute", operation_id)
+
+      # if pending, change to done
+      status = operation.data.get("status")
+      if status != "RUNNING" and status != "DONE":
+        logging.info("Setting operation to DONE: "+ operation_id)
+        operation.data["status"] = "DONE"
+        operation.data["progress"] = 100
+        operation.data["endTime"] = datetime.now().isoformat()
+        session.operations.touch(operation)
+
+    return operation
+
+  def parse_post_compute_instance(self, flow: http.HTTPFlow, params: dict) -> dict:
+    session = flow_session(flow)
+    api_version = params["version"]
+    project_id = params["project"]
+    zone = params["zone"]
+    now = datetime.now().isoformat()
+    # parse the compute instance body from the request
+    vm_url, instance_detail = self.build_instance(session.resources, request_json(flow), api_version, project_id, zone, now)
+    vm_name = instance_detail["name"]
+
+    # Store the compute instance as a resource
+    session.capture("gcp_compute_instance", vm_url, instance_detail)
+
+    # parse the project-id and zone from the path componet
+    operation_id = random.randint(1000000000000000000, 9999999999999999999)
+    target_id = random.randint(1000000000000000000, 9999999999999999999)
+    operation_name = "operation-compute-create-"+ project_id +"-"+ zone +"-"+ vm_name
+
+    # Create a new compute operation in the state of pending
+    zone_url = "https://www.googleapis.com/compute/"+ api_version +"/projects/"+ project_id +"/zones/"+ zone
+    operation = {
+     "kind": "compute#operation",
+     "id": str(operation_id),
+     "name": str(operation_name),
+     "zone": str(zone_url),
+     "operationType": "insert",
+     "targetLink": vm_url,
+     "targetId": str(target_id),
+     "status": "PENDING",
+     "user": "psychiac@psychiac.com",
+     "progress": 0,
+     "insertTime": now,
+     "startTime": now,
+     "endTime": now,
+     "selfLink": zone_url +"/operations/"+ operation_name
+    }
+    logging.info("Storing operation in PENDING: "+ operation_name)
+    with session.lock:
+      session.operations.put("compute", operation_name, operation)
+
+    # return the operation id
+    return operation_name
+
+  def build_instance(self, store: ResourceStore, data: dict, api_version: str, project_id: str, zone: str, now: str) -> tuple:
+    # (key, resource) of the instance an insert with this body creates, shared values are interned in store
+    region = "-".join(zone.split("-")[0:2])
+    vm_name = data.get('name') or "no-vm-name"
+    zone_url = store.intern("https://www.googleapis.com/compute/"+ api_version +"/projects/"+ project_id +"/zones/"+ zone)
+    vm_url = zone_url +"/instances/"+ vm_name
+
+    vm_id = random.randint(1000000000000000000, 9999999999999999999)
+    boot_disk = data.get('disks')[0]
+    disk_size_gb = boot_disk.get('initializeParams').get('diskSizeGb') or 10
+    tags = store.intern(data.get('tags').get('items'))
+    can_ip_forward = data.get('canIpForward')
+    service_account = data.get('serviceAccounts')[0]
+    service_account_email = service_account.get('email')
+    scopes = store.intern(service_account.get('scopes'))
+    metadata_items = data.get('metadata').get('items')
+    machine_type = data.get('machineType')
+    machine_type_url = store.intern("https://www.googleapis.com/compute/v1/" + machine_type)
+    guest_os_features = GUEST_OS_FEATURES
+    architecture = boot_disk.get('architecture')
+    cpu_platform = "Intel Broadwell"
+
+    instance_detail = {
+     "kind": "compute#instance",
+     "id": str(vm_id),
+     "creationTimestamp": now,
+     "name": vm_name,
+     "tags": {
+      "items": tags or [],
+      "fingerprint": "pOiUF0UJfOw="
+     },
+     "machineType": machine_type_url,
+     "status": "RUNNING",
+     "zone": zone_url,
+     "canIpForward": can_ip_forward or False,
+     "networkInterfaces": [],
+     "disks": [
+      {
+       "kind": "compute#attachedDisk",
+       "type": "PERSISTENT",
+       "mode": "READ_WRITE",
+       "source": zone_url +"/disks/"+ vm_name,
+       "deviceName": "persistent-disk-0",
+       "index": 0,
+       "boot": True,
+       "autoDelete": True,
+       "licenses": DEBIAN_12_LICENSES,
+       "interface": "SCSI",
+       "guestOsFeatures": guest_os_features or [],
+       "diskSizeGb": disk_size_gb,
+       "architecture": architecture
+      }
+     ],
+     "metadata": {
+      "kind": "compute#metadata",
+      "fingerprint": "BFuQ-sDJdpk=",
+      "items": metadata_items or []
+     },
+     "serviceAccounts": [
+      {
+       "email": service_account_email,
+       "scopes": scopes or DEFAULT_SCOPES
+      }
+     ],
+     "selfLink": vm_url,
+     "scheduling": {
+      "onHostMaintenance": "MIGRATE",
+      "automaticRestart": True,
+      "preemptible": False,
+      "provisioningModel": "STANDARD"
+     },
+     "cpuPlatform": cpu_platform,
+     "labelFingerprint": "42WmSpB8rSM=",
+     "startRestricted": False,
+     "deletionProtection": False,
+     "shieldedInstanceConfig": {
+      "enableSecureBoot": True,
+      "enableVtpm": True,
+      "enableIntegrityMonitoring": True
+     },
+     "shieldedInstanceIntegrityPolicy": {
+      "updateAutoLearnPolicy": True
+     },
+     "fingerprint": "w465_wnrOho=",
+     "lastStartTimestamp": now
+    }
+
+    network_interfaces = []
+    interface_count = 0
+    for req_interface in data.get('networkInterfaces'):
+      network = req_interface.get('network')
+      network_name = network.split("/")[-1]
+      interface = {
+        "kind": "compute#networkInterface",
+        "network": "https://www.googleapis.com/compute/v1/projects/"+ project_id +"/global/networks/"+ network_name,
+        "subnetwork": "https://www.googleapis.com/compute/v1/projects/"+ project_id +"/regions/"+ region +"/subnetworks/"+ network_name,
+        "networkIP": "10.0.0.0",
+        "name": "nic"+ str(interface_count),
+        "fingerprint": "o9wnSWdXEW4=",
+        "stackType": "IPV4_ONLY",
+        "nicType": "gVNIC"
+      }
+      access_configs = []
+      if req_interface.get('accessConfigs')[interface_count].get('type') == "ONE_TO_ONE_NAT":
+        access_config = {
+          "kind": "compute#accessConfig",
+          "type": "ONE_TO_ONE_NAT",
+          "name": "external-nat",
+          "natIP": "1.1.1.1",
+          "networkTier": "PREMIUM"
+        }
+        access_configs.append(access_config)
+
+      interface["accessConfigs"] = access_configs
+      network_interfaces.append(interface)
+      interface_count += 1
+
+    instance_detail["networkInterfaces"] = network_interfaces
+    return vm_url, instance_detail
+
+
+# Faker handlers are long-lived, one per backend
+iam_faker = GoogleIamFaker()
+crm_faker = GoogleCrmFaker()
+compute_faker = GoogleComputeFaker()
+run_faker = GoogleRunFaker()
+
+def register(router) -> None:
+  router.add("iam.googleapis.com", "POST", "v1/projects/{project}/serviceAccounts", iam_faker.post_service_account)
+  router.add("iam.googleapis.com", "GET", "v1/projects/{project}/serviceAccounts/{name}", iam_faker.get_service_account_detail)
+  router.add_fallback("iam.googleapis.com", passthrough)
+
+  router.add("cloudresourcemanager.googleapis.com", "POST", "v1/projects/{project}:getIamPolicy", crm_faker.get_iam_policy)
+  router.add("cloudresourcemanager.googleapis.com", "POST", "v1/projects/{project}:setIamPolicy", crm_faker.set_iam_policy)
+  router.add_fallback("cloudresourcemanager.googleapis.com", passthrough)
+
+  router.add("compute.googleapis.com", "POST", "compute/{version}/projects/{project}/zones/{zone}/instances", compute_faker.post_instance)
+  router.add("compute.googleapis.com", "GET", "compute/{version}/projects/{project}/zones/{zone}/operations/{name}", compute_faker.get_operation)
+  router.add("compute.googleapis.com", "GET", "compute/{version}/projects/{project}/zones/{zone}/instances/{name}", compute_faker.get_instance_detail)
+  router.add("compute.googleapis.com", "GET", "compute/{version}/projects/{project}/zones/{zone}/disks/{name}", compute_faker.get_disk)
+
+  router.add("run.googleapis.com", "PATCH", "{version}/projects/{project}/locations/{location}/services/{name}", run_faker.patch_service)
+  router.add("run.googleapis.com", "GET", "{version}/projects/{project}/locations/{location}/operations/{name}", run_faker.get_operation)
@@ -0,0 +1,237 @@
+"""
+Per-route metrics for the addon.
+
+Counts every terraform flow by route and outcome (faked, passthrough,
+replayed, unmatched, ...), with a latency histogram and the bytes in and
+out per route, how often each operation was polled and how often the
+real APIs throttled a passthrough call.  Proxy load is tracked as the
+event loop's lag and the depth of the worker pool queue.  Captured
+resources by type are read from the sessions when asked for.
+
+Served in the Prometheus text format on a local port during the run
+(metrics_port option), with the JSON summary at /summary, and written as
+the summary at the end.
+"""
+import json
+import time
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of the latency buckets in seconds, faked flows take well under a millisecond
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# operations in the summary, by most polled
+TOP_POLLED = 20
+
+def label(value: str) -> str:
+  return '"'+ str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") +'"'
+
+def quantile(buckets: list, count: int, q: float) -> float:
+  # upper bound of the bucket the q-th flow falls in, None past the last one
+  if not count:
+    return None
+  seen = 0
+  for bound, n in zip(BUCKETS, buckets):
+    seen += n
+    if seen >= q * count:
+      return bound
+  return None
+
+class Route:
+  __slots__ = ("outcomes", "buckets", "seconds", "count", "bytes_in", "bytes_out", "polls", "throttled")
+
+  def __init__(self) -> None:
+    self.outcomes = {}
+    # per bucket counts, not cumulative, the last one is +Inf
+    self.buckets = [0] * (len(BUCKETS) + 1)
+    self.seconds = 0.0
+    self.count = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.polls = 0
+    self.throttled = 0
+
+  def observe(self, seconds: float) -> None:
+    self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+    self.seconds += seconds
+    self.count += 1
+
+class Metrics:
+  def __init__(self, resources=None) -> None:
+    # callable returning {asset type: count} of the captured resources
+    self.resources = resources or dict
+    self.lock = threading.Lock()
+    self.routes = {}
+    # operation key -> times terraform polled it
+    self.polls = {}
+    # how late the event loop ran a timer, a histogram like a route's
+    self.lag = Route()
+    self.lag_max = 0.0
+    # flows waiting for or on a worker thread
+    self.queued = 0
+    self.queued_max = 0
+    self.started = time.time()
+    self.server = None
+
+  def observe(self, route: str, outcome: str, seconds: float, bytes_in: int, bytes_out: int, poll: str = None) -> None:
+    with self.lock:
+      stats = self.routes.get(route)
+      if stats is None:
+        stats = self.routes[route] = Route()
+      stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+      stats.observe(seconds)
+      stats.bytes_in += bytes_in
+      stats.bytes_out += bytes_out
+      if poll is not None:
+        stats.polls += 1
+        self.polls[poll] = self.polls.get(poll, 0) + 1
+
+  def upstream(self, route: str, bytes_out: int, status: int) -> None:
+    # response of a flow that went to the real API, known only once it answered
+    with self.lock:
+      stats = self.routes.get(route)
+      if stats is not None:
+        stats.bytes_out += bytes_out
+        if status == 429:
+          stats.throttled += 1
+
+  def loop_lag(self, seconds: float) -> None:
+    with self.lock:
+      self.lag.observe(seconds)
+      self.lag_max = max(self.lag_max, seconds)
+
+  def queue(self, delta: int) -> None:
+    with self.lock:
+      self.queued += delta
+      self.queued_max = max(self.queued_max, self.queued)
+
+  def render(self) -> str:
+    # the Prometheus text exposition format
+    resources = self.resources()
+    with self.lock:
+      routes = sorted(self.routes.items())
+      lines = ["# HELP psychiac_flows_total Terraform flows handled, by route and outcome",
+               "# TYPE psychiac_flows_total counter"]
+      for route, stats in routes:
+        for outcome, n in sorted(stats.outcomes.items()):
+          lines.append("psychiac_flows_total{route="+ label(route) +",outcome="+ label(outcome) +"} "+ str(n))
+
+      lines += ["# HELP psychiac_flow_seconds Time the addon spent on a flow, by route",
+                "# TYPE psychiac_flow_seconds histogram"]
+      for route, stats in routes:
+        seen = 0
+        for bound, n in zip(BUCKETS + ("+Inf",), stats.buckets):
+          seen += n
+          lines.append("psychiac_flow_seconds_bucket{route="+ label(route) +",le="+ label(bound) +"} "+ str(seen))
+        lines.append("psychiac_flow_seconds_sum{route="+ label(route) +"} "+ repr(stats.seconds))
+        lines.append("psychiac_flow_seconds_count{route="+ label(route) +"} "+ str(stats.count))
+
+      for name, field, text in (("bytes_in", "bytes_in", "Request body bytes, by route"),
+                                ("bytes_out", "bytes_out", "Response body bytes, faked or from upstream, by route"),
+                                ("operation_polls", "polls", "Operation polls answered, by route"),
+                                ("upstream_throttled", "throttled", "Passthrough calls the real API answered 429, by route")):
+        lines += ["# HELP psychiac_"+ name +"_total "+ text, "# TYPE psychiac_"+ name +"_total counter"]
+        for route, stats in routes:
+          lines.append("psychiac_"+ name +"_total{route="+ label(route) +"} "+ str(getattr(stats, field)))
+
+      lines += ["# HELP psychiac_operation_polls_max Most polls of a single operation",
+                "# TYPE psychiac_operation_polls_max gauge",
+                "psychiac_operation_polls_max "+ str(max(self.polls.values(), default=0))]
+
+      lines += ["# HELP psychiac_loop_lag_seconds How late the proxy event loop ran a timer",
+                "# TYPE psychiac_loop_lag_seconds histogram"]
+      seen = 0
+      for bound, n in zip(BUCKETS + ("+Inf",), self.lag.buckets):
+        seen += n
+        lines.append("psychiac_loop_lag_seconds_bucket{le="+ label(bound) +"} "+ str(seen))
+      lines.append("psychiac_loop_lag_seconds_sum "+ repr(self.lag.seconds))
+      lines.append("psychiac_loop_lag_seconds_count "+ str(self.lag.count))
+      lines += ["# HELP psychiac_worker_queue Flows waiting for or on a worker thread",
+                "# TYPE psychiac_worker_queue gauge",
+                "psychiac_worker_queue "+ str(self.queued)]
+
+    lines += ["# HELP psychiac_resources Captured resources, by asset type",
+              "# TYPE psychiac_resources gauge"]
+    for asset_type, n in sorted(resources.items()):
+      lines.append("psychiac_resources{type="+ label(asset_type) +"} "+ str(n))
+    return "\n".join(lines) +"\n"
+
+  def summary(self) -> dict:
+    resources = self.resources()
+    with self.lock:
+      routes = {}
+      for route, stats in sorted(self.routes.items()):
+        routes[route] = {
+          "flows": stats.count,
+          "outcomes": dict(stats.outcomes),
+          "mean_ms": round(stats.seconds / stats.count * 1000, 3) if stats.count else None,
+          # bucket upper bounds, good enough to size a runner
+          "p50_ms": self.ms(quantile(stats.buckets, stats.count, 0.5)),
+          "p99_ms": self.ms(quantile(stats.buckets, stats.count, 0.99)),
+          "bytes_in": stats.bytes_in,
+          "bytes_out": stats.bytes_out,
+          "operation_polls": stats.polls,
+          "throttled": stats.throttled,
+        }
+      polled = sorted(self.polls.items(), key=lambda item: -item[1])
+      return {
+        "type": "metrics",
+        "seconds": round(time.time() - self.started, 3),
+        "flows": sum(stats["flows"] for stats in routes.values()),
+        "throttled": sum(stats["throttled"] for stats in routes.values()),
+        "loop_lag": {
+          "p99_ms": self.ms(quantile(self.lag.buckets, self.lag.count, 0.99)),
+          "max_ms": round(self.lag_max * 1000, 3),
+        },
+        "worker_queue_max": self.queued_max,
+        "routes": routes,
+        "resources": dict(sorted(resources.items())),
+        "operations": {
+          "polled": len(polled),
+          "polls": sum(n for _, n in polled),
+          "most_polled": polled[:TOP_POLLED],
+        },
+      }
+
+  def ms(self, seconds: float) -> float:
+    return None if seconds is None else seconds * 1000
+
+  def write(self, path: str) -> None:
+    with open(path, "w") as outfile:
+      json.dump(self.summary(), outfile, indent=2)
+
+  def serve(self, port: int, host: str = "127.0.0.1") -> None:
+    # answer GET /metrics on a background thread until stop()
+    self.stop()
+    metrics = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0]
+        if path in ("/", "/metrics"):
+          body, content_type = metrics.render().encode("utf-8"), "text/plain; version=0.0.4"
+        elif path == "/summary":
+          body, content_type = json.dumps(metrics.summary()).encode("utf-8"), "application/json"
+        else:
+          self.send_error(404)
+          return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args) -> None:
+        pass
+
+    self.server = ThreadingHTTPServer((host, port), Handler)
+    self.server.daemon_threads = True
+    threading.Thread(target=self.server.serve_forever, name="psychiac-metrics", daemon=True).start()
+
+  def stop(self) -> None:
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
@@ -0,0 +1,130 @@
+"""
+Picks terraform's -parallelism for the applies psychiac runs.
+
+Nearly every provider call is answered by the fakers in well under a
+millisecond, so terraform's default of 10 resources in flight mostly
+leaves the proxy waiting.  The setting starts at the number of resources
+the plan applies (at least 10, at most MAX), under a ceiling kept per
+workspace in the user's cache directory (STATE_DIR, never the terraform
+directory) and moved by what the proxy saw:
+
+  - the real APIs throttling passthrough calls (429s) halves the ceiling,
+    and an apply that hits THROTTLE_LIMIT of them is stopped early and
+    run again at the new setting, up to RETRIES times
+  - the proxy falling behind (event loop lag or the worker queue backing
+    up, or faked flows getting slow) takes a quarter off for next time
+  - a clean run at the ceiling doubles it, up to MAX, unless this run of
+    psychiac already had to lower it
+
+The proxy's signals come from its metrics (see metrics.py), read live
+from its /summary endpoint and from metrics.json once it is done.
+"""
+import os
+import json
+import hashlib
+import threading
+import requests
+
+# terraform's own default, and the most psychiac asks for
+DEFAULT = 10
+MAX = 128
+
+# upstream 429s that stop an apply, and how many times it is retried lower
+THROTTLE_LIMIT = 3
+RETRIES = 2
+
+# signs of a proxy that can't keep up: event loop lag, flows queued for a worker, a faked route's p99
+LAG_MS = 50
+QUEUE_MAX = 32
+SLOW_MS = 25
+
+# one state file per workspace, named after its path, with the last RUNS_KEPT runs in it
+STATE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "psychiac", "parallelism")
+RUNS_KEPT = 20
+
+def state_path(target_dir):
+    name = hashlib.sha256(os.path.abspath(target_dir).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(STATE_DIR, name +".json")
+
+def proxy_load(summary):
+    # why the proxy looks overloaded in a metrics summary, or None
+    lag = (summary.get("loop_lag") or {}).get("p99_ms")
+    if lag is not None and lag > LAG_MS:
+        return f"event loop lag p99 {lag:g} ms"
+    if summary.get("worker_queue_max", 0) > QUEUE_MAX:
+        return f"{summary['worker_queue_max']} flows queued for workers"
+    for route, stats in summary.get("routes", {}).items():
+        p99 = stats.get("p99_ms")
+        if stats.get("outcomes", {}).get("faked") and p99 is not None and p99 > SLOW_MS:
+            return f"{route} p99 {p99:g} ms"
+    return None
+
+class Tuning:
+    """The parallelism of one workspace's applies, shared by its shards."""
+    def __init__(self, target_dir):
+        self.target_dir = os.path.abspath(target_dir)
+        self.path = state_path(target_dir)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        self.ceiling = state.get("ceiling", MAX)
+        self.last = state.get("parallelism")
+        self.history = state.get("runs", [])
+        self.runs = []
+        self.lowered = False
+
+    def choose(self, resources):
+        # the setting for an apply of `resources` resources, None when there was no plan to count them
+        with self.lock:
+            if resources is None:
+                wanted = self.last or DEFAULT
+                why = "last run's setting" if self.last else "terraform's default, no plan to size it from"
+            else:
+                wanted = min(max(resources, DEFAULT), MAX)
+                why = f"plan applies {resources} resources"
+            parallelism = max(1, min(wanted, self.ceiling))
+            if parallelism < wanted:
+                why += f", held to {self.ceiling} by earlier runs"
+            return parallelism, why
+
+    def watch(self, summary_url):
+        # a check for run_terraform to call while the apply runs, true stops it
+        def throttled():
+            try:
+                summary = requests.get(summary_url, timeout=1).json()
+            except (requests.RequestException, ValueError):
+                return False
+            return summary.get("throttled", 0) >= THROTTLE_LIMIT
+        return throttled
+
+    def update(self, parallelism, summary, stopped=False):
+        # move the ceiling on what an apply at `parallelism` saw, returns what happened
+        with self.lock:
+            throttled = summary.get("throttled", 0)
+            load = proxy_load(summary)
+            if stopped or throttled:
+                self.ceiling = max(1, parallelism // 2)
+                self.lowered = True
+                outcome = f"{throttled} upstream calls throttled, ceiling now {self.ceiling}"
+            elif load is not None:
+                self.ceiling = max(1, parallelism * 3 // 4)
+                self.lowered = True
+                outcome = f"proxy behind ({load}), ceiling now {self.ceiling}"
+            elif parallelism >= self.ceiling and self.ceiling < MAX and not self.lowered:
+                self.ceiling = min(MAX, self.ceiling * 2)
+                outcome = f"clean, ceiling raised to {self.ceiling}"
+            else:
+                outcome = "clean"
+            self.last = parallelism
+            self.runs.append({"parallelism": parallelism, "flows": summary.get("flows"),
+                              "seconds": summary.get("seconds"), "outcome": outcome})
+            return outcome
+
+    def save(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"target_dir": self.target_dir, "ceiling": self.ceiling, "parallelism": self.last,
+                       "runs": (self.history + self.runs)[-RUNS_KEPT:]}, f, indent=2)
@@ -0,0 +1,362 @@
+"""
+Plan-JSON fast path.
+
+Resources whose inputs are all known in a saved plan don't need the
+provider to run against the fakers: the assets the fakers would capture
+are built straight from `terraform show -json`, with the same builders
+the fakers use.  Only the changes the plan can't cover (unknown inputs,
+types the addon doesn't model, deletes) are left for a targeted apply
+through the proxy, and the apply is skipped when there are none.
+
+The plan's dependency graph also splits what is left into groups of
+resources that don't depend on each other, so a large workspace can be
+applied as several targeted applies at once.
+"""
+import os
+import json
+import subprocess
+
+import gcp
+
+from datetime import datetime
+from changeset import make_asset
+from store import ResourceStore
+
+# which addon asset type a terraform resource type is captured as
+PLAN_TYPES = {
+    "google_service_account": "gcp_iam_serviceaccount",
+    "google_compute_instance": "gcp_compute_instance",
+    "google_project_iam_policy": "gcp_cloudresourcemanager_iam_policy",
+    "google_cloud_run_v2_service": "gcp_run_service",
+}
+
+# cloud run v2 attributes terraform computes or keeps to itself, never part of the PATCH body
+RUN_OMIT = {"id", "name", "location", "project", "deletion_protection", "effective_labels", "terraform_labels",
+            "effective_annotations", "uid", "generation", "create_time", "update_time", "delete_time",
+            "expire_time", "creator", "last_modifier", "observed_generation", "terminal_condition",
+            "conditions", "latest_ready_revision", "latest_created_revision", "traffic_statuses", "uri",
+            "reconciling", "etag"}
+
+# cloud run v2 blocks that terraform models as a one item list but the API as an object
+RUN_BLOCKS = {"template", "scaling", "resources", "vpc_access", "binary_authorization", "startup_probe",
+              "liveness_probe", "http_get", "tcp_socket", "grpc", "value_source", "secret_key_ref",
+              "cloud_sql_instance", "empty_dir", "secret", "gcs", "nfs"}
+
+class Unknown(Exception):
+    """An input the fakers need is only known after apply."""
+
+def has_unknown(unknown):
+    if unknown is True:
+        return True
+    if isinstance(unknown, dict):
+        return any(has_unknown(u) for u in unknown.values())
+    if isinstance(unknown, list):
+        return any(has_unknown(u) for u in unknown)
+    return False
+
+class Values:
+    """The planned values of one resource, refusing to hand out the unknown ones."""
+    def __init__(self, after, unknown, expressions, defaults):
+        self.after = after or {}
+        self.unknown = unknown or {}
+        # what the resource block sets, None when its configuration wasn't found
+        self.expressions = expressions
+        # provider level project/region/zone, for attributes the resource leaves to the provider
+        self.defaults = defaults
+
+    def get(self, *path, default=None, computed=False):
+        # the value at path, raising Unknown if any of it is unknown.  With computed, an unknown
+        # value the configuration doesn't set is one the provider leaves out of the request and
+        # the fakers fill in themselves, so default is returned for it instead
+        value, unknown, expression = self.after, self.unknown, self.expressions
+        for step in path:
+            if unknown is True:
+                break
+            value = step_into(value, step)
+            unknown = step_into(unknown, step)
+            expression = step_into(expression, step)
+        if has_unknown(unknown):
+            if computed and self.expressions is not None and expression is None:
+                return default
+            raise Unknown(".".join(str(step) for step in path))
+        return default if value is None else value
+
+    def items(self, *path):
+        # the known elements of a nested block list, each still checked when it is read
+        return range(len(step_into_path(self.after, path) or []))
+
+    def provider(self, name):
+        # an attribute the provider fills in from its own config when the resource leaves it out
+        value = self.get(name, computed=True) or self.defaults.get(name)
+        if value is None:
+            raise Unknown(name)
+        return value
+
+def step_into(value, step):
+    if isinstance(value, dict):
+        return value.get(step)
+    if isinstance(value, list) and isinstance(step, int) and step < len(value):
+        return value[step]
+    return None
+
+def step_into_path(value, path):
+    for step in path:
+        value = step_into(value, step)
+    return value
+
+def camel(name):
+    head, *rest = name.split("_")
+    return head + "".join(word.capitalize() for word in rest)
+
+def api_shape(value, unknown, expression, omit=(), strict=False):
+    """
+    A terraform value as the API body the provider would send, with
+    snake_case keys camelCased.  Unknown attributes the configuration
+    doesn't set are computed by the API and left out, unknown ones it does
+    set (or any, when strict) raise Unknown.
+    """
+    if unknown is True:
+        raise Unknown()
+    if isinstance(value, dict):
+        body = {}
+        for key in unknown or {}:
+            if key not in omit and key not in value and has_unknown(unknown[key]) \
+                    and (strict or step_into(expression, key) is not None):
+                raise Unknown(key)
+        for key, item in value.items():
+            if key in omit:
+                continue
+            item_unknown, item_expression = step_into(unknown, key), step_into(expression, key)
+            if key in RUN_BLOCKS and isinstance(item, list):
+                item, item_unknown, item_expression = (step_into(item, 0), step_into(item_unknown, 0),
+                                                       step_into(item_expression, 0))
+            item = api_shape(item, item_unknown, item_expression, strict=strict)
+            if item not in (None, [], {}, ""):
+                body[camel(key)] = item
+        return body
+    if isinstance(value, list):
+        return [api_shape(item, step_into(unknown, i), step_into(expression, i), strict=strict)
+                for i, item in enumerate(value)]
+    return value
+
+def scope_url(scope):
+    return scope if "/" in scope else "https://www.googleapis.com/auth/"+ scope
+
+def service_account_assets(values):
+    project = values.provider("project")
+    data = {
+        "accountId": values.get("account_id"),
+        "serviceAccount": {"displayName": values.get("display_name", default=""),
+                           "description": values.get("description", default="")},
+    }
+    resource = gcp.iam_faker.build_service_account(project, data)
+    return [(resource["name"], resource)]
+
+def compute_instance_assets(values):
+    project = values.provider("project")
+    zone = values.provider("zone")
+    machine_type = values.get("machine_type")
+    if "/" not in machine_type:
+        machine_type = "projects/"+ project +"/zones/"+ zone +"/machineTypes/"+ machine_type
+    service_account = values.get("service_account", 0, default={})
+    metadata = values.get("metadata", default={})
+    data = {
+        "name": values.get("name"),
+        "machineType": machine_type,
+        "canIpForward": values.get("can_ip_forward", default=False),
+        "tags": {"items": values.get("tags", default=[])},
+        "disks": [{"boot": True, "initializeParams": {
+            "diskSizeGb": values.get("boot_disk", 0, "initialize_params", 0, "size", computed=True),
+            "sourceImage": values.get("boot_disk", 0, "initialize_params", 0, "image", computed=True)}}],
+        "serviceAccounts": [{"email": service_account.get("email"),
+                             "scopes": [scope_url(s) for s in service_account.get("scopes") or []]}],
+        "metadata": {"items": [{"key": k, "value": v} for k, v in sorted(metadata.items())]},
+        "networkInterfaces": [
+            {"network": values.get("network_interface", i, "network"),
+             "accessConfigs": [{"type": "ONE_TO_ONE_NAT"}] * len(values.items("network_interface", i, "access_config"))}
+            for i in values.items("network_interface")],
+    }
+    now = datetime.now().isoformat()
+    key, resource = gcp.compute_faker.build_instance(ResourceStore(), data, "v1", project, zone, now)
+    return [(key, resource)]
+
+def iam_policy_assets(values):
+    project = values.get("project")
+    policy = json.loads(values.get("policy_data"))
+    return [(project, gcp.crm_faker.build_policy(project, policy))]
+
+def run_service_assets(values):
+    project = values.provider("project")
+    location = values.get("location", computed=True) or values.provider("region")
+    body = api_shape(values.after, values.unknown, values.expressions, RUN_OMIT, strict=values.expressions is None)
+    key, resource = gcp.run_faker.build_service("v2", project, location, values.get("name"), body)
+    return [(key, resource)]
+
+BUILDERS = {
+    "google_service_account": service_account_assets,
+    "google_compute_instance": compute_instance_assets,
+    "google_project_iam_policy": iam_policy_assets,
+    "google_cloud_run_v2_service": run_service_assets,
+}
+
+def provider_defaults(plan):
+    # constant project/region/zone of each provider config, by config key
+    defaults = {}
+    for key, config in plan.get("configuration", {}).get("provider_config", {}).items():
+        expressions = config.get("expressions", {})
+        defaults[key] = {name: expressions[name]["constant_value"]
+                         for name in ("project", "region", "zone")
+                         if "constant_value" in expressions.get(name, {})}
+    return defaults
+
+def config_resources(module, prefix=""):
+    # every resource block in the configuration by its address without instance keys
+    for resource in module.get("resources", []):
+        yield prefix + resource["address"], resource
+    for name, call in module.get("module_calls", {}).items():
+        yield from config_resources(call.get("module", {}), prefix +"module."+ name +".")
+
+def config_address(change):
+    # module.a["x"].google_y.z[0] -> module.a.google_y.z
+    module = change.get("module_address", "")
+    parts = [part.split("[", 1)[0] for part in module.split(".")] if module else []
+    return ".".join(parts + [change["type"], change["name"]])
+
+def applied_changes(plan):
+    # the managed resource changes an apply would carry out
+    for change in plan.get("resource_changes", []):
+        if change.get("mode") == "managed" and change["change"]["actions"] not in (["no-op"], ["read"]):
+            yield change
+
+def plan_assets(plan, baseline=None):
+    """
+    Split a plan (`terraform show -json` output) into the assets it covers
+    and the addresses that still need an apply.
+
+    Returns (assets, targets).  Resources are shaped by the Google
+    backend's own builders and turned into assets against baseline (a
+    baseline.Baseline) exactly as a proxied apply would capture them, so
+    unchanged ones are left out the same way.
+    """
+    defaults = provider_defaults(plan)
+    configs = dict(config_resources(plan.get("configuration", {}).get("root_module", {})))
+    assets = []
+    targets = []
+    for change in applied_changes(plan):
+        actions = change["change"]["actions"]
+        builder = BUILDERS.get(change["type"])
+        # deletes, and types the addon doesn't model, are the provider's to send
+        if builder is None or "create" not in actions and "update" not in actions:
+            targets.append(change["address"])
+            continue
+
+        config = configs.get(config_address(change))
+        values = Values(change["change"].get("after"), change["change"].get("after_unknown"),
+                        None if config is None else config.get("expressions", {}),
+                        defaults.get((config or {}).get("provider_config_key", "google"), {}))
+        try:
+            built = builder(values)
+        except (Unknown, LookupError, AttributeError, TypeError, ValueError):
+            # not everything the fakers need is known (or modeled), let the provider send it
+            targets.append(change["address"])
+            continue
+        asset_type = PLAN_TYPES[change["type"]]
+        for key, resource in built:
+            asset = make_asset(asset_type, key, resource, baseline)
+            if asset["action"] != "NOOP":
+                assets.append(asset)
+
+    return assets, targets
+
+def reference_node(reference):
+    # the root module node a reference points at: google_x.y.id -> google_x.y, module.m.out -> module.m
+    parts = [part.split("[", 1)[0] for part in reference.split(".")]
+    if parts[0] == "module":
+        return "module."+ parts[1]
+    if parts[0] == "data":
+        return ".".join(parts[:3])
+    if parts[0] in ("var", "local", "each", "count", "path", "terraform", "self") or len(parts) < 2:
+        return None
+    return ".".join(parts[:2])
+
+def address_node(address):
+    # the root module node of a resource instance: a resource's own address, or its top module call
+    if address.startswith("module."):
+        return "module."+ address.split(".", 2)[1].split("[", 1)[0]
+    return address.split("[", 1)[0]
+
+def references(expressions):
+    # every reference made anywhere in a block's expressions
+    if isinstance(expressions, dict):
+        yield from expressions.get("references", [])
+        for value in expressions.values():
+            yield from references(value)
+    elif isinstance(expressions, list):
+        for value in expressions:
+            yield from references(value)
+
+def dependency_groups(plan):
+    """
+    Union-find over the root module's resources and module calls, joined
+    wherever one references or depends_on another.  Returns a function
+    giving the group of a resource address; resources in different groups
+    can be applied independently.  A module call is one node, so
+    everything in it stays together.
+    """
+    parent = {}
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    root = plan.get("configuration", {}).get("root_module", {})
+    blocks = [(resource["address"], resource) for resource in root.get("resources", [])]
+    blocks += [("module."+ name, call) for name, call in root.get("module_calls", {}).items()]
+    for node, block in blocks:
+        find(node)
+        for reference in list(references(block.get("expressions", {}))) + block.get("depends_on", []):
+            other = reference_node(reference)
+            if other is not None:
+                union(node, other)
+
+    return lambda address: find(address_node(address))
+
+def shard_targets(plan, targets, shards):
+    # split the targets into at most `shards` lists that share no dependencies, balanced by size
+    group_of = dependency_groups(plan)
+    groups = {}
+    for target in targets:
+        groups.setdefault(group_of(target), []).append(target)
+
+    bins = [[] for _ in range(min(shards, len(groups)))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(bins, key=len).extend(group)
+    return bins
+
+def plan_workspace(target_dir):
+    """
+    Plan the workspace and return `terraform show -json` of the plan, or
+    None when terraform can't produce one and the whole apply has to run.
+    """
+    plan_file = os.path.join(target_dir, "psychiac.tfplan")
+    try:
+        with open(os.path.join(target_dir, "stdout-tf-plan.log"), "w") as stdout, \
+                open(os.path.join(target_dir, "stderr-tf-plan.log"), "w") as stderr:
+            planned = subprocess.run(["terraform", "plan", "-input=false", "-out=psychiac.tfplan"],
+                                     cwd=target_dir, stdout=stdout, stderr=stderr)
+        if planned.returncode != 0:
+            return None
+        shown = subprocess.run(["terraform", "show", "-json", "psychiac.tfplan"],
+                               cwd=target_dir, capture_output=True)
+        if shown.returncode != 0:
+            return None
+    finally:
+        if os.path.exists(plan_file):
+            os.remove(plan_file)
+
+    return json.loads(shown.stdout)
@@ -0,0 +1,193 @@
+"""
+Profiling hooks for the addon.
+
+Off unless the profile option (or PSYCHIAC_PROFILE) turns it on:
+
+  deterministic  cProfile every flow, exact call counts and times.  Flows
+                 are handled one at a time while it is on.
+  sampling       the stacks of the threads handling a flow are sampled
+                 every profile_interval microseconds of CPU time, cheap
+                 enough for production sized runs.  Samples are taken by
+                 a SIGPROF timer on the main thread, mitmproxy's event
+                 loop, so they land where the time goes.  Off the main
+                 thread (an embedded proxy) a background thread takes
+                 them, which only gets a look in when the flows let go
+                 of the GIL and undercounts short flows.
+
+Each flow is filed under the route it took and writing the changeset
+under "done".  The profile is written to profile_dir as <route>.pstats
+(python -m pstats, snakeviz) and, when sampling, as profile.folded, the
+collapsed stacks flamegraph.pl and speedscope read, rooted at the route.
+"""
+import os
+import re
+import sys
+import signal
+import pstats
+import cProfile
+import threading
+
+MODES = ("off", "deterministic", "sampling")
+
+def slug(route: str) -> str:
+  return re.sub(r"[^A-Za-z0-9._-]+", "_", route).strip("_")
+
+def label(func: tuple) -> str:
+  filename, line, name = func
+  return name +" ("+ os.path.basename(filename) +":"+ str(line) +")"
+
+class Samples:
+  """Sampled stacks of one route, shaped like a profiler for pstats.Stats."""
+  def __init__(self, interval: float) -> None:
+    self.interval = interval
+    # (root, ..., leaf) of (filename, line, function) -> times it was seen
+    self.stacks = {}
+
+  def add(self, stacks: list) -> None:
+    for stack in stacks:
+      self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+  def create_stats(self) -> None:
+    # samples stand in for calls and samples * interval for time
+    stats = {}
+    for stack, n in self.stacks.items():
+      seconds = n * self.interval
+      seen = set()
+      for depth, func in enumerate(stack):
+        leaf = depth == len(stack) - 1
+        entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+        if leaf:
+          entry[2] += seconds
+        # recursion doesn't count a sample twice
+        if func not in seen:
+          seen.add(func)
+          entry[0] += n
+          entry[1] += n
+          entry[3] += seconds
+        if depth:
+          caller = entry[4].setdefault(stack[depth - 1], [0, 0, 0.0, 0.0])
+          caller[0] += n
+          caller[1] += n
+          caller[2] += seconds if leaf else 0.0
+          caller[3] += seconds
+    self.stats = {func: (cc, nc, tt, ct, {caller: tuple(c) for caller, c in callers.items()})
+                  for func, (cc, nc, tt, ct, callers) in stats.items()}
+
+class Profiler:
+  def __init__(self, mode: str = "off", interval_us: int = 1000) -> None:
+    self.mode = mode
+    self.interval = max(interval_us, 100) / 1e6
+    # route -> pstats.Stats when deterministic, Samples when sampling
+    self.profiles = {}
+    # reentrant, the signal handler can interrupt a flow holding it
+    self.lock = threading.RLock()
+    # thread id -> stacks sampled from the flow it is handling
+    self.active = {}
+    self.stopped = threading.Event()
+    self.thread = None
+    self.previous = None
+    if mode == "sampling":
+      if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+        self.previous = signal.signal(signal.SIGPROF, self.on_signal)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+      else:
+        self.thread = threading.Thread(target=self.sample_every, name="psychiac-sampler", daemon=True)
+        self.thread.start()
+
+  def enabled(self) -> bool:
+    return self.mode != "off"
+
+  def run(self, route: str, fn, *args):
+    # call fn(*args) and file its profile under route, or under the route fn returns when that is None
+    if self.mode == "off":
+      return fn(*args)
+
+    result = None
+    if self.mode == "deterministic":
+      profile = cProfile.Profile()
+      with self.lock:
+        profile.enable()
+        try:
+          result = fn(*args)
+        finally:
+          profile.disable()
+          self.file(route or result, profile)
+      return result
+
+    stacks = []
+    ident = threading.get_ident()
+    with self.lock:
+      self.active[ident] = stacks
+    try:
+      result = fn(*args)
+    finally:
+      with self.lock:
+        del self.active[ident]
+        self.file(route or result, stacks)
+    return result
+
+  def file(self, route: str, profile) -> None:
+    # flows that took no route (not terraform, control) aren't kept
+    if not route:
+      return
+    if self.mode == "deterministic":
+      stats = self.profiles.get(route)
+      if stats is None:
+        self.profiles[route] = pstats.Stats(profile)
+      else:
+        stats.add(profile)
+    else:
+      self.profiles.setdefault(route, Samples(self.interval)).add(profile)
+
+  def on_signal(self, signum, frame) -> None:
+    self.sample()
+
+  def sample_every(self) -> None:
+    while not self.stopped.wait(self.interval):
+      self.sample()
+
+  def sample(self) -> None:
+    frames = sys._current_frames()
+    with self.lock:
+      for ident, stacks in self.active.items():
+        frame = frames.get(ident)
+        if frame is not None:
+          stacks.append(self.stack(frame))
+
+  def stack(self, frame) -> tuple:
+    # the frames between Profiler.run and the sampler, root first
+    while frame is not None and frame.f_code.co_filename == __file__:
+      frame = frame.f_back
+    stack = []
+    while frame is not None and frame.f_code is not Profiler.run.__code__:
+      code = frame.f_code
+      stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+      frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+  def stop(self) -> None:
+    if self.previous is not None:
+      signal.setitimer(signal.ITIMER_PROF, 0)
+      signal.signal(signal.SIGPROF, self.previous)
+      self.previous = None
+    if self.thread is not None:
+      self.stopped.set()
+      self.thread.join()
+      self.thread = None
+
+  def write(self, directory: str) -> None:
+    self.stop()
+    os.makedirs(directory, exist_ok=True)
+    with self.lock:
+      for route, profile in sorted(self.profiles.items()):
+        if self.mode == "sampling" and not profile.stacks:
+          # a route whose flows were all quicker than the interval
+          continue
+        stats = profile if self.mode == "deterministic" else pstats.Stats(profile)
+        stats.dump_stats(os.path.join(directory, slug(route) +".pstats"))
+      if self.mode == "sampling":
+        with open(os.path.join(directory, "profile.folded"), "w") as outfile:
+          for route, samples in sorted(self.profiles.items()):
+            for stack, n in samples.stacks.items():
+              outfile.write(";".join([route] + [label(func) for func in stack]) +" "+ str(n) +"\n")
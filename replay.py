@@ -0,0 +1,118 @@
+"""
+Record/replay cache for the calls the fakers let through to the real APIs.
+
+Upstream responses are stored in an sqlite file keyed by the normalized
+method, url and body of the request, so later runs can answer them
+without the network.  Entries expire after a TTL and can be dropped by
+url prefix.  Token endpoints are never recorded, the file is meant to be
+kept between CI runs and must not carry live credentials.
+
+List or invalidate entries with: python replay.py <replay.db> [list|invalidate] [url prefix]
+"""
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from datetime import datetime, timedelta, timezone
+
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# hop-by-hop or length headers that must not be replayed as recorded
+SKIP_HEADERS = {"transfer-encoding", "connection", "keep-alive", "content-length"}
+
+# token endpoints, never recorded.  Offline runs get a made-up token from them instead
+CREDENTIAL_HOSTS = {"oauth2.googleapis.com", "sts.googleapis.com", "iamcredentials.googleapis.com",
+                    "metadata.google.internal"}
+
+def fake_token(host: str) -> dict:
+  # a token response shaped like the host's, good for an hour, that no real API would accept
+  token = "psychiac-offline-token"
+  if host == "iamcredentials.googleapis.com":
+    expires = datetime.now(timezone.utc) + timedelta(hours=1)
+    return {"accessToken": token, "expireTime": expires.strftime("%Y-%m-%dT%H:%M:%SZ")}
+  response = {"access_token": token, "token_type": "Bearer", "expires_in": 3599}
+  if host == "sts.googleapis.com":
+    response["issued_token_type"] = "urn:ietf:params:oauth:token-type:access_token"
+  return response
+
+def normalize_url(url: str) -> str:
+  parts = urlsplit(url)
+  query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+  return parts.scheme.lower() +"://"+ parts.netloc.lower() + parts.path + ("?"+ query if query else "")
+
+def normalize_body(content: bytes) -> bytes:
+  # json bodies that only differ in key order or whitespace are the same request
+  if not content:
+    return b""
+  try:
+    return json.dumps(json.loads(content), sort_keys=True, separators=(",", ":")).encode("utf-8")
+  except ValueError:
+    return content
+
+def request_key(method: str, url: str, content: bytes) -> str:
+  h = hashlib.sha256()
+  h.update(method.upper().encode("utf-8") + b"\n")
+  h.update(normalize_url(url).encode("utf-8") + b"\n")
+  h.update(normalize_body(content))
+  return h.hexdigest()
+
+class ReplayCache:
+  def __init__(self, path: str, ttl: int = 86400) -> None:
+    self.path = path
+    self.ttl = ttl
+    # the connection is shared by the addon's worker threads
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, method TEXT, url TEXT,"
+                    " status INTEGER, headers TEXT, content BLOB, recorded REAL)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS responses_url ON responses (url)")
+    self.db.commit()
+
+  def lookup(self, key: str, ignore_ttl: bool = False) -> tuple:
+    # (status, headers, content) of a recorded response, or None
+    with self.lock:
+      row = self.db.execute("SELECT status, headers, content, recorded FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is None:
+      return None
+    if not ignore_ttl and self.ttl and time.time() - row[3] > self.ttl:
+      return None
+    return row[0], json.loads(row[1]), row[2]
+
+  def record(self, key: str, method: str, url: str, status: int, headers: list, content: bytes) -> None:
+    if urlsplit(url).hostname in CREDENTIAL_HOSTS:
+      return
+    headers = [[k, v] for k, v in headers if k.lower() not in SKIP_HEADERS]
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (key, method, normalize_url(url), status, json.dumps(headers), content, time.time()))
+      self.db.commit()
+
+  def invalidate(self, prefix: str = "") -> int:
+    # drop every entry whose url starts with prefix, all of them by default
+    with self.lock:
+      cursor = self.db.execute("DELETE FROM responses WHERE substr(url, 1, ?) = ?", (len(prefix), prefix))
+      self.db.commit()
+    return cursor.rowcount
+
+  def entries(self):
+    return self.db.execute("SELECT method, url, status, length(content), recorded FROM responses ORDER BY url")
+
+  def close(self) -> None:
+    self.db.close()
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 3 or sys.argv[2] not in ("list", "invalidate"):
+    print("Usage: python replay.py <replay.db> [list|invalidate] [url prefix]")
+    sys.exit(1)
+  cache = ReplayCache(sys.argv[1])
+  prefix = sys.argv[3] if len(sys.argv) > 3 else ""
+  if sys.argv[2] == "list":
+    for method, url, status, size, recorded in cache.entries():
+      if url.startswith(prefix):
+        print(time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(recorded)), status, method, url, str(size) +"B")
+  else:
+    print(str(cache.invalidate(prefix)) +" entries invalidated")
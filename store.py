@@ -0,0 +1,191 @@
+"""
+Store for the resources and operations the fakers capture.
+
+Records are kept per asset type and looked up by their key, so lookups
+never build or re-split string keys.  Values that repeat across
+thousands of resources (scopes, license lists, zone urls...) can be
+interned so every record shares one copy.
+
+Each record also caches its data serialized as a response body.  The
+cache is tied to the record's version, which is bumped with touch()
+whenever the data is changed in place.
+
+A store can also be given a memory ceiling with spill_to().  Records are
+then kept in memory least recently used first out: once the serialized
+size of the hot ones passes the ceiling, the coldest are written to an
+sqlite file and their data dropped, and read back the next time their
+data is asked for.
+"""
+import os
+import sys
+import json
+import zlib
+import sqlite3
+import tempfile
+import collections
+
+class Record:
+  __slots__ = ("asset_type", "key", "_data", "version", "cached", "cached_version", "spill", "spilled_version")
+
+  def __init__(self, asset_type: str, key: str, data: dict) -> None:
+    self.asset_type = asset_type
+    self.key = key
+    self._data = data
+    self.version = 0
+    self.cached = None
+    self.cached_version = -1
+    # where the data goes when it is evicted, and the version last written there
+    self.spill = None
+    self.spilled_version = -1
+
+  @property
+  def data(self) -> dict:
+    if self.spill is not None:
+      if self._data is None:
+        self.spill.load(self)
+      else:
+        self.spill.used(self)
+    return self._data
+
+  def payload(self) -> bytes:
+    # data as json bytes, serialized once per version
+    if self.cached_version != self.version:
+      self.cached = json.dumps(self.data).encode("utf-8")
+      self.cached_version = self.version
+    return self.cached
+
+class Spill:
+  """The evicted records of one store, in an sqlite file of their own that is removed on close."""
+  def __init__(self, directory: str, max_bytes: int) -> None:
+    os.makedirs(directory, exist_ok=True)
+    fd, self.path = tempfile.mkstemp(dir=directory, prefix="psychiac-spill-", suffix=".db")
+    os.close(fd)
+    # only touched by the flows of one session at a time, but not always from the same thread
+    self.db = sqlite3.connect(self.path, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode = OFF")
+    self.db.execute("CREATE TABLE records (type TEXT, key TEXT, data BLOB, PRIMARY KEY (type, key))")
+    self.max_bytes = max_bytes
+    # records with their data in memory, least recently used first, and their serialized sizes
+    self.hot = collections.OrderedDict()
+    self.hot_bytes = 0
+
+  def admit(self, record: Record, size: int) -> None:
+    record.spill = self
+    self.forget(record)
+    self.hot[record] = size
+    self.hot_bytes += size
+    # the record just admitted stays, even if it is bigger than the ceiling by itself
+    while self.hot_bytes > self.max_bytes and len(self.hot) > 1:
+      self.evict()
+
+  def used(self, record: Record) -> None:
+    if record in self.hot:
+      self.hot.move_to_end(record)
+
+  def forget(self, record: Record) -> None:
+    size = self.hot.pop(record, None)
+    if size is not None:
+      self.hot_bytes -= size
+
+  def evict(self) -> None:
+    record, size = self.hot.popitem(last=False)
+    self.hot_bytes -= size
+    # records read back and not changed since are already on disk as they are
+    if record.spilled_version != record.version:
+      blob = zlib.compress(record.payload(), 1)
+      self.db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?)", (record.asset_type, record.key, blob))
+      record.spilled_version = record.version
+    record._data = None
+    record.cached = None
+    record.cached_version = -1
+
+  def load(self, record: Record) -> None:
+    row = self.db.execute("SELECT data FROM records WHERE type = ? AND key = ?",
+                          (record.asset_type, record.key)).fetchone()
+    payload = zlib.decompress(row[0])
+    record._data = json.loads(payload)
+    record.cached = payload
+    record.cached_version = record.version
+    self.admit(record, len(payload))
+
+  def close(self) -> None:
+    self.db.close()
+    os.remove(self.path)
+
+def freeze(value):
+  # a hashable stand-in for a json value, used as the interning key
+  if isinstance(value, dict):
+    return ("d",) + tuple((k, freeze(v)) for k, v in value.items())
+  if isinstance(value, list):
+    return ("l",) + tuple(freeze(v) for v in value)
+  return value
+
+class ResourceStore:
+  def __init__(self) -> None:
+    self.by_type = {}
+    self.interned = {}
+    self.spill = None
+
+  def spill_to(self, directory: str, max_bytes: int) -> None:
+    # keep at most about max_bytes of serialized records in memory and the rest in directory,
+    # or everything in memory again with no directory
+    old = self.spill
+    self.spill = None
+    if old is not None:
+      # read everything back without evicting anything on the way
+      old.max_bytes = float("inf")
+      for record in self:
+        record.data
+        record.spill = None
+        record.spilled_version = -1
+      old.close()
+
+    if directory:
+      self.spill = Spill(directory, max_bytes)
+      for record in self:
+        self.spill.admit(record, len(record.payload()))
+
+  def close(self) -> None:
+    if self.spill is not None:
+      self.spill.close()
+      self.spill = None
+
+  def put(self, asset_type: str, key: str, data: dict) -> Record:
+    records = self.by_type.setdefault(asset_type, {})
+    old = records.get(key)
+    if old is not None and self.spill is not None:
+      self.spill.forget(old)
+
+    record = Record(sys.intern(asset_type), key, data)
+    records[key] = record
+    if self.spill is not None:
+      # the serialization is the size that counts against the ceiling, and usually the response too
+      self.spill.admit(record, len(record.payload()))
+    return record
+
+  def record(self, asset_type: str, key: str) -> Record:
+    return self.by_type.get(asset_type, {}).get(key)
+
+  def touch(self, record: Record) -> None:
+    # the record's data was changed in place, drop its cached payload
+    record.version += 1
+    record.cached = None
+
+  def __contains__(self, type_key: tuple) -> bool:
+    return type_key[1] in self.by_type.get(type_key[0], {})
+
+  def __iter__(self):
+    # every record, grouped by asset type
+    for records in self.by_type.values():
+      yield from records.values()
+
+  def __len__(self) -> int:
+    return sum(len(records) for records in self.by_type.values())
+
+  def intern(self, value):
+    # return the shared copy of a value that many records carry, callers must not mutate it
+    if isinstance(value, str):
+      return sys.intern(value)
+    if value is None:
+      return value
+    return self.interned.setdefault(freeze(value), value)